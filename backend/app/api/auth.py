@@ -7,13 +7,18 @@ from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from ..database import get_db
 from ..models.user import User
-from ..utils.auth import verify_password, get_password_hash, create_access_token
+from ..utils.auth import verify_password, verify_password_cached, get_password_hash, create_access_token
 from ..config import settings
 from pydantic import BaseModel, EmailStr
 
 router = APIRouter()
 
 
+# Хеш-заглушка для проверки пароля несуществующего пользователя.
+# Считается один раз при импорте, чтобы первый такой логин не платил за лишний bcrypt
+_DUMMY_HASH = get_password_hash("dummy-password-for-timing")
+
+
 class UserRegister(BaseModel):
     username: str
     password: str
@@ -30,7 +35,7 @@ class Token(BaseModel):
 
 
 @router.post("/register", response_model=Token)
-async def register(user_data: UserRegister, db: Session = Depends(get_db)):
+def register(user_data: UserRegister, db: Session = Depends(get_db)):
     """
     Регистрация нового пользователя
     """
@@ -42,8 +47,11 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
         )
 
     # Проверяем, существует ли пользователь
-    existing_user = db.query(User).filter(User.username == user_data.username).first()
-    if existing_user:
+    # (EXISTS по уникальному индексу username, без загрузки строки)
+    username_taken = db.query(
+        db.query(User.id).filter(User.username == user_data.username).exists()
+    ).scalar()
+    if username_taken:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already registered"
@@ -64,26 +72,33 @@ async def register(user_data: UserRegister, db: Session = Depends(get_db)):
 
     db.add(new_user)
     db.commit()
-    db.refresh(new_user)
 
-    # Создаем токен
+    # Создаем токен (логин берем из запроса - перечитывать пользователя не нужно)
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": new_user.username}, expires_delta=access_token_expires
+        data={"sub": user_data.username}, expires_delta=access_token_expires
     )
 
     return {"access_token": access_token, "token_type": "bearer"}
 
 
+# def, а не async def: bcrypt и запросы к БД идут в пуле потоков, не блокируя event loop
 @router.post("/login", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """
     Вход пользователя (получение токена)
     """
-    # Ищем пользователя
-    user = db.query(User).filter(User.username == form_data.username).first()
+    # Ищем пользователя: берем только нужные колонки, без ORM-объекта
+    user = db.query(
+        User.username, User.hashed_password, User.is_active
+    ).filter(User.username == form_data.username).first()
+
+    if not user:
+        # Тратим на проверку столько же, сколько для существующего пользователя,
+        # чтобы по времени ответа нельзя было перебирать логины
+        verify_password(form_data.password, _DUMMY_HASH)
 
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    if not user or not verify_password_cached(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
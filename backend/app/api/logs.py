@@ -3,31 +3,55 @@ API endpoint для логирования с фронтенда
 """
 from fastapi import APIRouter, Depends, Request
 from pydantic import BaseModel
-from typing import Optional
+from typing import Literal, Optional
 from datetime import datetime
+from pathlib import Path
 import logging
 from ..models.user import User
 from ..utils.auth import get_current_active_user
+from ..utils.queued_logging import attach_queued_file_handler
 
 router = APIRouter()
 
+# Форматы логов не используют имя файла/строку, поток и процесс вызывающего,
+# поэтому не тратим время на их вычисление для каждой записи
+logging._srcfile = None
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
 # Настройка логгера для фронтенда
 frontend_logger = logging.getLogger("frontend")
 frontend_logger.setLevel(logging.DEBUG)
+frontend_logger.propagate = False
 
-# Создаём handler для файла
+# Пишем в файл через очередь: запрос не ждет диска, запись идет в фоновом потоке
 if not frontend_logger.handlers:
-    handler = logging.FileHandler("frontend.log", encoding='utf-8')
     formatter = logging.Formatter(
         '%(asctime)s | %(levelname)s | %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
-    handler.setFormatter(formatter)
-    frontend_logger.addHandler(handler)
+    attach_queued_file_handler(frontend_logger, Path("frontend.log"), formatter)
+
+# Шаблон сообщения в зависимости от наличия context и url
+MESSAGE_FORMATS = {
+    (False, False): "[USER:%s] %s",
+    (True, False): "[USER:%s] %s | Context: %s",
+    (False, True): "[USER:%s] %s | URL: %s",
+    (True, True): "[USER:%s] %s | Context: %s | URL: %s",
+}
+
+# Уровень с фронтенда -> метод логгера
+LEVEL_DISPATCH = {
+    'error': frontend_logger.error,
+    'warn': frontend_logger.warning,
+    'debug': frontend_logger.debug,
+    'info': frontend_logger.info,
+}
 
 
 class LogEntry(BaseModel):
-    level: str  # 'info', 'warn', 'error', 'debug'
+    level: Literal['info', 'warn', 'error', 'debug'] = 'info'
     message: str
     context: Optional[dict] = None
     url: Optional[str] = None
@@ -47,23 +71,15 @@ async def log_from_frontend(
     user_id = current_user.id if current_user else "anonymous"
     username = current_user.username if current_user else "anonymous"
 
-    log_message = f"[USER:{username}] {log_entry.message}"
-
-    if log_entry.context:
-        log_message += f" | Context: {log_entry.context}"
-
-    if log_entry.url:
-        log_message += f" | URL: {log_entry.url}"
+    has_context = bool(log_entry.context)
+    has_url = bool(log_entry.url)
+    args = (username, log_entry.message)
+    if has_context:
+        args += (log_entry.context,)
+    if has_url:
+        args += (log_entry.url,)
 
-    # Записываем в лог с нужным уровнем
-    level = log_entry.level.lower()
-    if level == 'error':
-        frontend_logger.error(log_message)
-    elif level == 'warn':
-        frontend_logger.warning(log_message)
-    elif level == 'debug':
-        frontend_logger.debug(log_message)
-    else:
-        frontend_logger.info(log_message)
+    # Записываем в лог с нужным уровнем (строку соберет сам логгер)
+    LEVEL_DISPATCH[log_entry.level](MESSAGE_FORMATS[has_context, has_url], *args)
 
     return {"status": "logged"}
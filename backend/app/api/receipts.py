@@ -5,43 +5,231 @@ API endpoints для управления чеками и документами
 - С суммой (fiscal, ticket, hotel, other) - требуют сумму
 - Без суммы (boarding, confirmation) - подтверждающие документы
 """
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Form
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status, UploadFile, File, Form
+from sqlalchemy import or_
 from sqlalchemy.orm import Session
 from pydantic import BaseModel
 from pathlib import Path
-from typing import Optional, Union
+from typing import BinaryIO, Optional, Set, Tuple, Union
 from datetime import datetime, date
+import os
 import shutil
 import re
 import logging
 import hashlib
-from ..database import get_db
+from ..database import get_db, SessionLocal
 from ..models.user import User
 from ..models.trip import Trip
 from ..models.receipt import Receipt, DocumentType
 from ..utils.auth import get_current_active_user
-from ..services.qr_reader import QRReader
+from ..utils.queued_logging import attach_queued_file_handler
+from ..services.qr_reader import get_qr_reader, process_receipt_file_cached
 from ..config import settings
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
+
+# Отладочный лог распознавания (пишется на диск в фоне через очередь)
+qr_debug_logger = logging.getLogger("qr_debug")
+qr_debug_logger.setLevel(logging.DEBUG)
+qr_debug_logger.propagate = False
+if not qr_debug_logger.handlers:
+    attach_queued_file_handler(
+        qr_debug_logger,
+        settings.BASE_DIR / "uploads" / "qr_debug.log",
+        logging.Formatter('%(asctime)s | %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+    )
 MAX_UPLOAD_BYTES = 25 * 1024 * 1024  # 25 MB
 AMOUNT_MIN = 0.0
 AMOUNT_MAX = 200000.0
+UPLOAD_CHUNK_BYTES = 1024 * 1024  # 1 MB
+HASH_CHUNK_BYTES = 4 * 1024 * 1024  # 4 MB
+ALLOWED_EXTENSIONS = frozenset({'.pdf', '.jpg', '.jpeg', '.png'})
+ALLOWED_EXTENSIONS_TEXT = ', '.join(sorted(ALLOWED_EXTENSIONS))
 
+# Чеки, которые сейчас распознаются в фоне (см. _recognize_receipt)
+_pending_receipt_ids: Set[int] = set()
 
-def _sha256_bytes(data: bytes) -> str:
-    return hashlib.sha256(data).hexdigest()
+# Командировки, папка чеков которых уже создана этим процессом
+_known_receipts_dirs: Set[int] = set()
 
+# Корень папок чеков (настройки читаются один раз при старте)
+RECEIPTS_ROOT = settings.BASE_DIR / settings.UPLOAD_DIR / "receipts"
 
-def _sha256_file(path: Path) -> str:
+
+def _save_upload(source: BinaryIO, dest: Path) -> Tuple[int, str]:
+    """Потоково записать загрузку на диск, посчитав размер и sha256 за один проход.
+
+    Чтение прекращается, как только размер превысил MAX_UPLOAD_BYTES.
+    Куски и так крупные, поэтому пишем без буфера Python (buffering=0):
+    каждый кусок уходит в write() напрямую, без лишнего копирования.
+    """
     hasher = hashlib.sha256()
-    with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+    size = 0
+    with open(dest, "wb", buffering=0) as out:
+        while chunk := source.read(UPLOAD_CHUNK_BYTES):
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                break
             hasher.update(chunk)
+            view = memoryview(chunk)
+            while view:
+                view = view[out.write(view):]
+    return size, hasher.hexdigest()
+
+
+def _sha256_file(path: Path) -> str:
+    with open(path, "rb", buffering=0) as f:
+        # Python 3.11+: цикл чтения в C, без промежуточных bytes-объектов
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # Иначе читаем в один переиспользуемый буфер
+        hasher = hashlib.sha256()
+        buffer = bytearray(HASH_CHUNK_BYTES)
+        view = memoryview(buffer)
+        while n := f.readinto(buffer):
+            hasher.update(view[:n])
     return hasher.hexdigest()
 
 
+def _backfill_legacy_hashes(db: Session, trip_id: int, file_size: int) -> None:
+    """Досчитать размер/sha256 для чеков, загруженных до появления колонок.
+
+    Хешируются только файлы того же размера, что и входящий: у остальных
+    запоминается размер, и в следующий раз они отсекаются прямо в SQL.
+    """
+    legacy_receipts = db.query(Receipt).filter(
+        Receipt.trip_id == trip_id,
+        Receipt.sha256.is_(None),
+        or_(Receipt.file_size.is_(None), Receipt.file_size == file_size)
+    ).all()
+    if not legacy_receipts:
+        return
+
+    for existing in legacy_receipts:
+        existing_path = Path(existing.file_path)
+        if not existing_path.is_absolute():
+            existing_path = settings.BASE_DIR / existing_path
+        try:
+            if existing.file_size is None:
+                if not existing_path.exists():
+                    continue
+                existing.file_size = existing_path.stat().st_size
+            if existing.file_size == file_size:
+                existing.sha256 = _sha256_file(existing_path)
+        except Exception as e:
+            logger.warning("[UPLOAD] Hash backfill failed for %s: %s", existing_path, e)
+
+    db.commit()
+
+
+def _is_duplicate(db: Session, trip_id: int, file_size: int, incoming_hash: str) -> bool:
+    """Есть ли в командировке документ с тем же содержимым."""
+    _backfill_legacy_hashes(db, trip_id, file_size)
+    duplicate = db.query(Receipt.id).filter(
+        Receipt.trip_id == trip_id,
+        Receipt.sha256 == incoming_hash
+    ).first()
+    return duplicate is not None
+
+
+def _receipts_dir(trip_id: int) -> Path:
+    """Папка чеков командировки; mkdir выполняется один раз на процесс."""
+    receipts_dir = RECEIPTS_ROOT / str(trip_id)
+    if trip_id not in _known_receipts_dirs:
+        receipts_dir.mkdir(parents=True, exist_ok=True)
+        _known_receipts_dirs.add(trip_id)
+    return receipts_dir
+
+
+def forget_receipts_dir(trip_id: int) -> None:
+    """Сбросить кеш папки чеков (вызывается при удалении командировки)."""
+    _known_receipts_dirs.discard(trip_id)
+
+
+def is_receipt_pending(receipt_id: int) -> bool:
+    """Идёт ли ещё фоновое распознавание чека."""
+    return receipt_id in _pending_receipt_ids
+
+
+def _recognize_receipt(receipt_id: int, file_path: Path, file_extension: str) -> None:
+    """
+    Фоновое распознавание QR/OCR загруженного чека.
+
+    Выполняется после отправки ответа на загрузку, результат сохраняется в БД.
+    Данные, которые пользователь уже успел ввести вручную, не перезаписываются.
+    """
+    try:
+        qr_reader = get_qr_reader()
+
+        # Через кеш: lazy-обработка в trips.py потом не разбирает этот файл повторно
+        qr_string, qr_data = process_receipt_file_cached(str(file_path))
+        logger.info("[UPLOAD] QR parsed: qr_string=%s qr_data=%s file=%s", bool(qr_string), qr_data, file_path)
+        qr_debug_logger.debug("[UPLOAD] file=%s qr_string=%s qr_data=%s", file_path, bool(qr_string), qr_data)
+
+        # Дополнительный fallback: если qr_data не получен, пытаемся распарсить текст/ocr напрямую
+        if not qr_data:
+            try:
+                if file_extension == '.pdf':
+                    qr_data = qr_reader.parse_text_from_pdf(str(file_path))
+                    logger.info("[UPLOAD] Fallback parse_text_from_pdf: %s", qr_data)
+                elif file_extension in ['.jpg', '.jpeg', '.png', '.bmp']:
+                    qr_data = qr_reader.parse_text_from_image(str(file_path))
+                    logger.info("[UPLOAD] Fallback parse_text_from_image: %s", qr_data)
+            except Exception as e:
+                logger.error("[UPLOAD] Fallback parse failed: %s", e, exc_info=True)
+            qr_debug_logger.debug("[UPLOAD] fallback file=%s qr_data=%s", file_path, qr_data)
+
+        # Валидация суммы (результат сохраняем в чек - фронтенд покажет предупреждение)
+        parse_warning = None
+        if qr_data and qr_data.get('amount') is not None:
+            amount_value = qr_data.get('amount')
+            try:
+                amount_float = float(amount_value)
+                if amount_float < AMOUNT_MIN or amount_float > AMOUNT_MAX:
+                    parse_warning = "amount_out_of_range"
+                    logger.warning("[UPLOAD] Amount out of range: %s for file %s", amount_float, file_path)
+                    qr_data['amount'] = None
+            except Exception:
+                parse_warning = "amount_invalid"
+                logger.warning("[UPLOAD] Amount invalid: %s for file %s", amount_value, file_path)
+                qr_data['amount'] = None
+
+        if parse_warning is None and (not qr_data or qr_data.get('amount') is None):
+            parse_warning = "amount_missing"
+            logger.warning("[UPLOAD] Amount not detected for file %s", file_path)
+
+        db = SessionLocal()
+        try:
+            receipt = db.query(Receipt).filter(Receipt.id == receipt_id).first()
+            # Чек могли удалить или отредактировать, пока шло распознавание
+            if receipt is None or receipt.is_manual:
+                return
+
+            receipt.has_qr = qr_string is not None
+            receipt.parse_attempted_at = datetime.utcnow()
+            receipt.parse_warning = parse_warning
+            if qr_data:
+                receipt.amount = qr_data.get('amount')
+                receipt.receipt_date = qr_data.get('date')
+                receipt.fn = qr_data.get('fn')
+                receipt.fd = qr_data.get('fd')
+                receipt.fp = qr_data.get('fp')
+                receipt.qr_raw = qr_data.get('raw')
+            else:
+                logger.warning("[UPLOAD] qr_data is empty for file %s", file_path)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+    except Exception as e:
+        logger.error("[UPLOAD] Background recognition failed for receipt %s: %s", receipt_id, e, exc_info=True)
+    finally:
+        _pending_receipt_ids.discard(receipt_id)
+
+
 class ReceiptUpdate(BaseModel):
     category: Optional[str] = None
     document_type: Optional[str] = None  # fiscal, boarding, confirmation, etc.
@@ -51,9 +239,12 @@ class ReceiptUpdate(BaseModel):
     requires_amount: Optional[bool] = None
 
 
+# def: потоковая запись файла на диск с подсчетом sha256 и поиск дубля в БД
+# выполняются в пуле потоков FastAPI, а не в event loop
 @router.post("/trip/{trip_id}/upload")
-async def upload_receipt(
+def upload_receipt(
     trip_id: int,
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     category: str = Form("other"),
     document_type: str = Form("fiscal"),  # fiscal = с суммой, boarding = без суммы
@@ -82,170 +273,115 @@ async def upload_receipt(
         )
 
     # Проверяем формат файла
-    allowed_extensions = ['.pdf', '.jpg', '.jpeg', '.png']
-    file_extension = Path(file.filename).suffix.lower()
+    file_extension = os.path.splitext(file.filename)[1].lower()
 
-    if file_extension not in allowed_extensions:
+    if file_extension not in ALLOWED_EXTENSIONS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Only {', '.join(allowed_extensions)} files are allowed"
+            detail=f"Only {ALLOWED_EXTENSIONS_TEXT} files are allowed"
         )
 
-    # Читаем файл в память для проверки дублей/размера
-    file_bytes = await file.read()
-    file_size = len(file_bytes)
-    if file_size == 0:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Пустой файл. Проверьте загрузку."
-        )
-    if file_size > MAX_UPLOAD_BYTES:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail=f"Слишком большой файл (>{MAX_UPLOAD_BYTES // (1024 * 1024)} MB)."
-        )
-
-    incoming_hash = _sha256_bytes(file_bytes)
-
-    # Проверка на дубликаты в рамках командировки
-    existing_receipts = db.query(Receipt).filter(Receipt.trip_id == trip_id).all()
-    for existing in existing_receipts:
-        existing_path = Path(existing.file_path)
-        if not existing_path.is_absolute():
-            existing_path = settings.BASE_DIR / existing_path
-        try:
-            if not existing_path.exists():
-                continue
-            if existing_path.stat().st_size != file_size:
-                continue
-            if _sha256_file(existing_path) == incoming_hash:
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail="Похоже, этот документ уже был загружен в эту командировку."
-                )
-        except HTTPException:
-            raise
-        except Exception as e:
-            logger.warning("[UPLOAD] Duplicate check failed for %s: %s", existing_path, e)
-
-    # Создаем папку для чеков - всегда используем абсолютный путь
-    receipts_dir = settings.BASE_DIR / settings.UPLOAD_DIR / "receipts" / str(trip_id)
-    receipts_dir.mkdir(parents=True, exist_ok=True)
+    # Папка для чеков - всегда абсолютный путь
+    receipts_dir = _receipts_dir(trip_id)
 
     # Генерируем уникальное имя файла
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     filename = f"{timestamp}_{file.filename}"
     file_path = receipts_dir / filename
 
-    # Сохраняем файл
-    with open(file_path, "wb") as buffer:
-        buffer.write(file_bytes)
-
-    # Определяем, требуется ли сумма для этого типа документа
-    requires_amount = document_type not in DocumentType.NO_AMOUNT_TYPES
-
-    # Читаем QR код только если требуется сумма (пропускаем OCR для посадочных и подтверждающих)
-    qr_reader = QRReader()
-    debug_log_path = settings.BASE_DIR / "uploads" / "qr_debug.log"
-    qr_string = None
-    qr_data = None
-
-    if requires_amount:
-        # Распознаём только если нужна сумма
-        qr_string, qr_data = qr_reader.process_receipt_file(str(file_path))
-        logger.info("[UPLOAD] QR parsed: qr_string=%s qr_data=%s file=%s", bool(qr_string), qr_data, file_path)
+    # Пишем загрузку во временный .part файл, считая размер и хеш за один проход
+    part_path = file_path.with_name(file_path.name + ".part")
+    try:
         try:
-            debug_log_path.parent.mkdir(parents=True, exist_ok=True)
-            with open(debug_log_path, "a", encoding="utf-8") as debug_log:
-                debug_log.write(f"[UPLOAD] file={file_path} qr_string={bool(qr_string)} qr_data={qr_data}\\n")
-        except Exception as e:
-            logger.error("[UPLOAD] Failed to write debug log: %s", e)
-
-        # Дополнительный fallback: если qr_data не получен, пытаемся распарсить текст/ocr напрямую
-        if not qr_data:
-            try:
-                if file_extension == '.pdf':
-                    qr_data = qr_reader.parse_text_from_pdf(str(file_path))
-                    logger.info("[UPLOAD] Fallback parse_text_from_pdf: %s", qr_data)
-                elif file_extension in ['.jpg', '.jpeg', '.png', '.bmp']:
-                    qr_data = qr_reader.parse_text_from_image(str(file_path))
-                    logger.info("[UPLOAD] Fallback parse_text_from_image: %s", qr_data)
-            except Exception as e:
-                logger.error("[UPLOAD] Fallback parse failed: %s", e, exc_info=True)
-            try:
-                with open(debug_log_path, "a", encoding="utf-8") as debug_log:
-                    debug_log.write(f"[UPLOAD] fallback file={file_path} qr_data={qr_data}\\n")
-            except Exception as e:
-                logger.error("[UPLOAD] Failed to write fallback debug log: %s", e)
-    else:
-        logger.info("[UPLOAD] Skipping OCR for document without amount: %s", file_path)
+            file_size, incoming_hash = _save_upload(file.file, part_path)
+        except FileNotFoundError:
+            # Папку удалили в обход кеша (например, другой воркер) - создаем заново
+            forget_receipts_dir(trip_id)
+            _receipts_dir(trip_id)
+            file_size, incoming_hash = _save_upload(file.file, part_path)
+        if file_size == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Пустой файл. Проверьте загрузку."
+            )
+        if file_size > MAX_UPLOAD_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Слишком большой файл (>{MAX_UPLOAD_BYTES // (1024 * 1024)} MB)."
+            )
 
-    warnings = []
+        # Проверка на дубликаты в рамках командировки (по сохранённому хешу)
+        if _is_duplicate(db, trip_id, file_size, incoming_hash):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail="Похоже, этот документ уже был загружен в эту командировку."
+            )
+    except BaseException:
+        part_path.unlink(missing_ok=True)
+        raise
 
-    # Валидация суммы
-    if qr_data and qr_data.get('amount') is not None:
-        amount_value = qr_data.get('amount')
-        try:
-            amount_float = float(amount_value)
-            if amount_float < AMOUNT_MIN or amount_float > AMOUNT_MAX:
-                warnings.append("amount_out_of_range")
-                logger.warning("[UPLOAD] Amount out of range: %s for file %s", amount_float, file_path)
-                qr_data['amount'] = None
-        except Exception:
-            warnings.append("amount_invalid")
-            logger.warning("[UPLOAD] Amount invalid: %s for file %s", amount_value, file_path)
-            qr_data['amount'] = None
+    part_path.replace(file_path)
 
-    # Предупреждение о сумме только если она требуется
-    if requires_amount and (not qr_data or qr_data.get('amount') is None):
-        warnings.append("amount_missing")
-        logger.warning("[UPLOAD] Amount not detected for file %s", file_path)
+    # Определяем, требуется ли сумма для этого типа документа
+    requires_amount = document_type not in DocumentType.NO_AMOUNT_TYPES
 
     # Получаем относительный путь для БД
     relative_path = file_path.relative_to(settings.BASE_DIR)
 
-    # Создаем запись в БД
-    receipt = Receipt(
-        trip_id=trip_id,
-        file_path=str(relative_path).replace('\\', '/'),  # Используем прямые слеши
-        file_name=file.filename,
-        category=category,
-        document_type=document_type,
-        requires_amount=requires_amount,
-        has_qr=qr_string is not None
-    )
+    # Файл уже на месте: если запись в БД не создастся, он остался бы на диске
+    # без чека, который на него ссылается - удаляем его сразу
+    try:
+        # Создаем запись в БД
+        receipt = Receipt(
+            trip_id=trip_id,
+            user_id=current_user.id,
+            file_path=str(relative_path).replace('\\', '/'),  # Используем прямые слеши
+            file_name=file.filename,
+            file_size=file_size,
+            sha256=incoming_hash,
+            category=category,
+            document_type=document_type,
+            requires_amount=requires_amount,
+            has_qr=False
+        )
 
-    # Если QR прочитан, заполняем данные
-    if qr_data:
-        receipt.amount = qr_data.get('amount')
-        receipt.receipt_date = qr_data.get('date')
-        receipt.fn = qr_data.get('fn')
-        receipt.fd = qr_data.get('fd')
-        receipt.fp = qr_data.get('fp')
-        receipt.qr_raw = qr_data.get('raw')
+        # flush выдает id без повторного SELECT; ответ собираем до commit,
+        # пока атрибуты не истекли (иначе обращение к ним снова сходит в БД)
+        db.add(receipt)
+        db.flush()
+        receipt_id = receipt.id
+        response = {
+            "id": receipt_id,
+            "file_name": file.filename,
+            "category": category,
+            "document_type": document_type,
+            "requires_amount": requires_amount,
+            "amount": None,
+            "receipt_date": None,
+            "has_qr": False,
+            "qr_data": None,
+            "status": "pending" if requires_amount else "processed",
+            # Проверки суммы - после фонового распознавания, см. parse_warning в списке чеков
+            "warnings": []
+        }
+        db.commit()
+    except BaseException:
+        file_path.unlink(missing_ok=True)
+        raise
+
+    # QR/OCR распознаём в фоне после ответа - только если требуется сумма
+    # (пропускаем OCR для посадочных и подтверждающих)
+    if requires_amount:
+        _pending_receipt_ids.add(receipt_id)
+        background_tasks.add_task(_recognize_receipt, receipt_id, file_path, file_extension)
     else:
-        logger.warning("[UPLOAD] qr_data is empty for file %s", file_path)
-
-    db.add(receipt)
-    db.commit()
-    db.refresh(receipt)
+        logger.info("[UPLOAD] Skipping OCR for document without amount: %s", file_path)
 
-    return {
-        "id": receipt.id,
-        "file_name": receipt.file_name,
-        "category": receipt.category,
-        "document_type": receipt.document_type,
-        "requires_amount": receipt.requires_amount,
-        "amount": receipt.amount,
-        "receipt_date": receipt.receipt_date,
-        "has_qr": receipt.has_qr,
-        "qr_data": qr_data if qr_data else None,
-        "warnings": warnings
-    }
+    return response
 
 
 @router.put("/{receipt_id}", response_model=dict)
-async def update_receipt(
+def update_receipt(
     receipt_id: int,
     receipt_data: ReceiptUpdate,
     current_user: User = Depends(get_current_active_user),
@@ -254,9 +390,9 @@ async def update_receipt(
     """Обновить данные чека (редактирование)"""
 
     # Получаем чек и проверяем права
-    receipt = db.query(Receipt).join(Trip).filter(
+    receipt = db.query(Receipt).filter(
         Receipt.id == receipt_id,
-        Trip.user_id == current_user.id
+        Receipt.user_id == current_user.id
     ).first()
 
     if not receipt:
@@ -308,21 +444,24 @@ async def update_receipt(
     # Помечаем как ручной ввод если изменены данные
     if any(field in update_data for field in ['amount', 'receipt_date', 'org_name']):
         receipt.is_manual = True
+        # Пользователь проверил данные сам - предупреждение распознавания больше не актуально
+        receipt.parse_warning = None
 
-    db.commit()
-    db.refresh(receipt)
-
-    return {
+    # Ответ собираем до commit: после него атрибуты истекают и потребовали бы refresh
+    response = {
         "id": receipt.id,
         "category": receipt.category,
         "amount": receipt.amount,
         "receipt_date": receipt.receipt_date,
         "org_name": receipt.org_name
     }
+    db.commit()
+
+    return response
 
 
 @router.delete("/{receipt_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_receipt(
+def delete_receipt(
     receipt_id: int,
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
@@ -330,9 +469,9 @@ async def delete_receipt(
     """Удалить чек"""
 
     # Получаем чек и проверяем права
-    receipt = db.query(Receipt).join(Trip).filter(
+    receipt = db.query(Receipt).filter(
         Receipt.id == receipt_id,
-        Trip.user_id == current_user.id
+        Receipt.user_id == current_user.id
     ).first()
 
     if not receipt:
@@ -346,12 +485,12 @@ async def delete_receipt(
     if not file_path.is_absolute():
         file_path = settings.BASE_DIR / file_path
 
-    if file_path.exists():
-        try:
-            file_path.unlink()
-            logger.info("[DELETE] Deleted file: %s", file_path)
-        except Exception as e:
-            logger.warning("[DELETE] Failed to delete file %s: %s", file_path, e)
+    # Один unlink вместо exists()+unlink(): отсутствующий файл не считается ошибкой
+    try:
+        file_path.unlink(missing_ok=True)
+        logger.info("[DELETE] Deleted file: %s", file_path)
+    except Exception as e:
+        logger.warning("[DELETE] Failed to delete file %s: %s", file_path, e)
 
     # Удаляем запись из БД
     db.delete(receipt)
@@ -6,84 +6,606 @@ API endpoints для управления командировками
 2. ПОСЛЕ поездки: АО + СЗ (только при перерасходе)
 """
 
-from fastapi import APIRouter, Depends, HTTPException, status
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
-from datetime import date, time, datetime
-from typing import List, Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import or_, tuple_, update
+from sqlalchemy.orm import Session, raiseload, selectinload
+from pydantic import BaseModel, ConfigDict, TypeAdapter, computed_field
+from datetime import date, time, datetime, timedelta, timezone
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from operator import attrgetter
 import logging
-from ..database import get_db
+import multiprocessing
+import os
+import shutil
+import threading
+import zipfile
+from urllib.parse import quote
+from ..database import get_db, SessionLocal
 from ..models.user import User
 from ..models.trip import Trip, TripStatus
 from ..models.receipt import Receipt
 from ..utils.auth import get_current_active_user
-from ..services.document_generator_simple import SimpleDocumentGenerator, calculate_per_diem_days
-from ..services.qr_reader import QRReader
+from ..utils.zero_copy import ZeroCopyFileResponse
+from ..services.document_generator_simple import (
+    SimpleDocumentGenerator, calculate_per_diem_days, run_generation, zip_compress_type, ZIP_COMPRESSLEVEL
+)
+from ..services.qr_reader import process_receipt_file_cached
 from ..config import settings
+from .receipts import RECEIPTS_ROOT, forget_receipts_dir, is_receipt_pending
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
+# Пул для разбора файлов чеков (QR/OCR): ограничен числом ядер
+_parse_pool = ThreadPoolExecutor(
+    max_workers=os.cpu_count() or 1,
+    thread_name_prefix="receipt-parse"
+)
+
+# Пул для удаления файлов командировки: папки чеков и документов лежат в разных
+# каталогах (а то и на разных дисках), их удаление идет параллельно
+_cleanup_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="trip-cleanup")
+
+# Пул процессов для генерации документов: шаблонизация docx/xlsx держит GIL,
+# в отдельном процессе она не тормозит остальные запросы. Создается лениво.
+# Генерация редкая (по кнопке пользователя) - пары процессов хватает
+GENERATION_WORKERS = 2
+_generation_pool: Optional[ProcessPoolExecutor] = None
+_generation_pool_lock = threading.Lock()
+
+
+def _get_generation_pool() -> ProcessPoolExecutor:
+    global _generation_pool
+    with _generation_pool_lock:
+        if _generation_pool is None:
+            # spawn, а не fork: процесс сервера многопоточный, fork может унести чужие блокировки
+            _generation_pool = ProcessPoolExecutor(
+                max_workers=GENERATION_WORKERS,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _generation_pool
 
-def _fill_missing_receipt_data(receipts: List[Receipt], db: Session) -> None:
-    """Попытаться заполнить недостающие суммы/даты по файлам (lazy-обработка)."""
-    if not receipts:
-        return
 
-    qr_reader = QRReader()
-    updated = False
+def _generate_in_process(method: str, trip_data: dict, **kwargs) -> dict:
+    """Вызвать метод SimpleDocumentGenerator в пуле процессов и дождаться результата"""
+    future = _get_generation_pool().submit(
+        run_generation, settings.TEMPLATES_DIR, settings.OUTPUT_DIR, method, trip_data, **kwargs
+    )
+    return future.result()
 
-    for receipt in receipts:
-        if receipt.is_manual:
-            continue
 
-        if receipt.amount not in (None, 0):
-            continue
+# Фоновая генерация документов после поездки (generate-post-trip?background=true):
+# trip_id -> состояние последней задачи. Хранится в памяти процесса, а не в Trip.status:
+# после перезапуска сервера "зависшего" статуса генерации не остается
+_post_trip_jobs: Dict[int, dict] = {}
+_post_trip_jobs_lock = threading.Lock()
 
-        file_path = Path(receipt.file_path)
-        if not file_path.is_absolute():
-            file_path = settings.BASE_DIR / file_path
 
-        if not file_path.exists():
-            logger.warning("[PARSE] File not found for receipt %s: %s", receipt.id, file_path)
-            continue
+def _post_trip_documents(result: dict) -> List[str]:
+    """Названия созданных документов после поездки"""
+    documents = ["Авансовый отчёт"]
+    if result.get('needs_sz_dopay'):
+        documents.append("Служебная записка (доплата)")
+    return documents
+
+
+def _generate_post_trip_background(trip_id: int, trip_data: dict, custom_dir: Optional[Path]) -> None:
+    """
+    Генерация документов после поездки после отправки ответа.
+
+    Результат сохраняется в _post_trip_jobs, флаги командировки - в БД.
+    """
+    try:
+        result = _generate_in_process('generate_post_trip', trip_data, custom_output_dir=custom_dir)
 
+        # Своя сессия: сессия запроса к этому моменту уже закрыта.
+        # Командировку могли удалить, пока шла генерация - тогда UPDATE ничего не затронет
+        db = SessionLocal()
         try:
-            qr_string, qr_data = qr_reader.process_receipt_file(str(file_path))
-        except Exception as e:
-            logger.error("[PARSE] Failed to parse receipt %s: %s", receipt.id, e, exc_info=True)
+            db.execute(
+                update(Trip)
+                .where(Trip.id == trip_id)
+                .values(post_trip_docs_generated=True, status=TripStatus.REPORTED)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+        job = {
+            "status": "done",
+            "files": result,
+            "documents": _post_trip_documents(result),
+            "to_return": trip_data['to_return'],
+            "needs_sz_dopay": result.get('needs_sz_dopay', False),
+            "folder": result.get('folder', '')
+        }
+        logger.info("[POST-TRIP] Background generation successful: %s", result)
+    except Exception as e:
+        logger.error("[POST-TRIP] Background generation failed for trip %s: %s", trip_id, e, exc_info=True)
+        job = {"status": "failed", "error": f"Ошибка генерации: {str(e)}"}
+
+    with _post_trip_jobs_lock:
+        _post_trip_jobs[trip_id] = job
+
+
+# Загрузка командировок вместе с чеками. В DEBUG любая другая ленивая загрузка,
+# которой понадобился бы SQL, падает сразу - так N+1 не вернется незаметно
+_WITH_RECEIPTS = (selectinload(Trip.receipts),) + (
+    (raiseload('*', sql_only=True),) if settings.DEBUG else ()
+)
+
+
+def _load_owned_trip(trip_id: int, current_user: User, db: Session, *options) -> Trip:
+    """Найти командировку текущего пользователя или вернуть 404."""
+    trip = db.query(Trip).options(*options).filter(
+        Trip.id == trip_id,
+        Trip.user_id == current_user.id
+    ).first()
+
+    if not trip:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Trip not found"
+        )
+
+    return trip
+
+
+def get_owned_trip(
+    trip_id: int,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Trip:
+    """Dependency: командировка текущего пользователя (без чеков)."""
+    return _load_owned_trip(trip_id, current_user, db)
+
+
+def get_owned_trip_with_receipts(
+    trip_id: int,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+) -> Trip:
+    """Dependency: командировка текущего пользователя вместе с чеками (одним selectin-запросом)."""
+    return _load_owned_trip(trip_id, current_user, db, *_WITH_RECEIPTS)
+
+
+# Корневая папка документов: CUSTOM_OUTPUT_DIR, если указан, иначе OUTPUT_DIR.
+# Настройки читаются один раз при старте, поэтому и корень считаем один раз
+_CUSTOM_OUTPUT_DIR: Optional[Path] = Path(settings.CUSTOM_OUTPUT_DIR) if settings.CUSTOM_OUTPUT_DIR else None
+_OUTPUT_ROOT: Path = _CUSTOM_OUTPUT_DIR or settings.OUTPUT_DIR
+
+
+class TripPaths(NamedTuple):
+    """Пути к результатам командировки (все от одного корня документов)"""
+    folder_name: str
+    base_path: Path      # Папка командировки
+    docs_path: Path      # Сгенерированные документы
+    receipts_path: Path  # Копии чеков
+    zip_path: Path       # Архив всех документов
+
+
+def _trip_paths(trip: Trip) -> TripPaths:
+    """Все пути командировки в одном месте"""
+    folder_name = trip.folder_name
+    base_path = _OUTPUT_ROOT / folder_name
+    return TripPaths(
+        folder_name=folder_name,
+        base_path=base_path,
+        docs_path=base_path / "documents",
+        receipts_path=base_path / "receipts",
+        zip_path=_OUTPUT_ROOT / f"{folder_name}.zip"
+    )
+
+
+def _existing_files(folder: Path, names: Tuple[str, ...]) -> List[str]:
+    """Какие из names есть в папке (один просмотр каталога вместо stat на каждый файл)"""
+    try:
+        with os.scandir(folder) as entries:
+            present = {entry.name for entry in entries}
+    except FileNotFoundError:
+        return []
+    return [name for name in names if name in present]
+
+
+def _remove_entries(parent: Path, names: Set[str]) -> None:
+    """Удалить из parent файлы и папки с указанными именами за один просмотр каталога"""
+    try:
+        with os.scandir(parent) as entries:
+            targets = [entry for entry in entries if entry.name in names]
+    except FileNotFoundError:
+        logger.debug("[DELETE] Directory not found: %s", parent)
+        return
+
+    for entry in targets:
+        # Тип берется из DirEntry, без дополнительного stat
+        if entry.is_dir(follow_symlinks=False):
+            logger.debug("[DELETE] Removing directory: %s", entry.path)
+            shutil.rmtree(entry.path)
+        else:
+            logger.debug("[DELETE] Removing file: %s", entry.path)
+            os.unlink(entry.path)
+
+
+# Размер куска при упаковке файлов в потоковый ZIP
+_ZIP_CHUNK_SIZE = 64 * 1024
+
+
+class _ZipChunkSink:
+    """
+    Приемник для ZipFile без seek/tell: копит записанные байты до выдачи клиенту.
+
+    На таком потоке zipfile пишет размеры в дескрипторы после данных,
+    поэтому архив можно отдавать частями, не собирая его целиком.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+# Уровень сжатия записи: публичный ZipInfo.compress_level с Python 3.13, раньше - _compresslevel
+_ZIPINFO_LEVEL_ATTR = 'compress_level' if hasattr(zipfile.ZipInfo, 'compress_level') else '_compresslevel'
+
+
+def _zip_stream(files: List[Tuple[str, str]]) -> Iterator[bytes]:
+    """ZIP-архив из файлов (имя в архиве, путь) по мере сжатия, без временного файла"""
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zf:
+        for arc_name, path in files:
+            info = zipfile.ZipInfo.from_file(path, arc_name)
+            info.compress_type = zip_compress_type(arc_name)
+            # ZipFile.open(ZipInfo) не берет compresslevel архива - задаем уровень у записи
+            setattr(info, _ZIPINFO_LEVEL_ATTR, ZIP_COMPRESSLEVEL)
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                while chunk := src.read(_ZIP_CHUNK_SIZE):
+                    dst.write(chunk)
+                    data = sink.take()
+                    if data:
+                        yield data
+            data = sink.take()
+            if data:
+                yield data
+    # Центральный каталог дописывается при закрытии архива
+    yield sink.take()
+
+
+def _attachment_disposition(filename: str) -> str:
+    """Content-Disposition для скачивания (кириллица - по RFC 5987, как в FileResponse)"""
+    return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def _file_response(path: Path, filename: str, media_type: str) -> Response:
+    """
+    Отдать готовый файл из папки документов.
+
+    При USE_XACCEL тело отдает nginx (sendfile), воркер возвращает только заголовки.
+    Иначе файл уходит через zerocopysend, если ASGI-сервер его поддерживает.
+    """
+    if settings.USE_XACCEL:
+        relative = path.relative_to(_OUTPUT_ROOT).as_posix()
+        return Response(
+            status_code=status.HTTP_200_OK,
+            media_type=media_type,
+            headers={
+                "X-Accel-Redirect": settings.XACCEL_PREFIX + quote(relative),
+                "Content-Disposition": _attachment_disposition(filename)
+            }
+        )
+    return ZeroCopyFileResponse(path=path, media_type=media_type, filename=filename)
+
+
+def _zip_response(files: List[Tuple[str, str]], filename: str) -> StreamingResponse:
+    """Отдать файлы потоковым ZIP"""
+    return StreamingResponse(
+        _zip_stream(files),
+        media_type='application/zip',
+        headers={"Content-Disposition": _attachment_disposition(filename)}
+    )
+
+
+# Неудачное распознавание не повторяем так часто: только если файл
+# изменился после попытки или попытка была давно
+_PARSE_RETRY_AFTER = timedelta(minutes=30)
+
+
+def _parse_recently_attempted(attempted_at: Optional[datetime], file_path: Path, now: datetime) -> bool:
+    """Файл уже пытались разобрать недавно и с тех пор он не менялся"""
+    if attempted_at is None or now - attempted_at >= _PARSE_RETRY_AFTER:
+        return False
+    try:
+        mtime = file_path.stat().st_mtime
+    except OSError:
+        return False
+    return mtime <= attempted_at.replace(tzinfo=timezone.utc).timestamp()
+
+
+# Префикс для относительных путей чеков в БД (считается один раз)
+_BASE_DIR_PREFIX = str(settings.BASE_DIR) + os.sep
+
+
+def _absolute_receipt_path(file_path: str) -> str:
+    """Абсолютный путь к файлу чека - строками, без разбора через Path"""
+    return file_path if os.path.isabs(file_path) else _BASE_DIR_PREFIX + file_path
+
+
+# Поля сотрудника и командировки, общие для всех генераторов: читаются одним
+# attrgetter на объект, а не десятком отдельных обращений к атрибутам ORM
+_EMPLOYEE_FIELDS = ('fio', 'tab_no', 'department', 'position', 'org_name')
+_TRIP_FIELDS = ('destination_city', 'destination_org', 'date_from', 'date_to', 'purpose')
+_employee_attrs = attrgetter(*_EMPLOYEE_FIELDS)
+_trip_attrs = attrgetter(*_TRIP_FIELDS)
+
+
+def _base_trip_data(trip: Trip, user: User) -> dict:
+    """Общая часть trip_data: кто едет, куда, когда и зачем"""
+    data = dict(zip(_EMPLOYEE_FIELDS, _employee_attrs(user)))
+    data.update(zip(_TRIP_FIELDS, _trip_attrs(trip)))
+    return data
+
+
+def _parse_receipt_file(file_path: Path) -> Tuple[Optional[str], Optional[dict]]:
+    """Разобрать файл чека (через кеш), не пробрасывая ошибки разбора."""
+    try:
+        # Кеш по (путь, mtime, размер): повторные чтения не разбирают файл заново
+        return process_receipt_file_cached(str(file_path))
+    except FileNotFoundError:
+        logger.warning("[PARSE] File not found: %s", file_path)
+    except Exception as e:
+        logger.error("[PARSE] Failed to parse %s: %s", file_path, e, exc_info=True)
+    return None, None
+
+
+def _fill_missing_receipt_data(trip_id: int, db: Session) -> None:
+    """
+    Попытаться заполнить недостающие суммы/даты по файлам (lazy-обработка).
+
+    Обычно чеки распознаются в фоне сразу после загрузки. Здесь - последняя
+    попытка перед генерацией документов (например, если фоновая задача
+    потерялась при перезапуске сервера).
+    """
+    # Кандидатов отбирает БД: не ручной ввод и сумма не распознана
+    candidates = db.query(
+        Receipt.id, Receipt.file_path, Receipt.receipt_date, Receipt.parse_attempted_at
+    ).filter(
+        Receipt.trip_id == trip_id,
+        or_(Receipt.is_manual.is_(False), Receipt.is_manual.is_(None)),
+        or_(Receipt.amount.is_(None), Receipt.amount == 0)
+    ).all()
+
+    to_parse = []
+    for receipt in candidates:
+        # Чек ещё распознаётся в фоне после загрузки
+        if is_receipt_pending(receipt.id):
             continue
 
+        to_parse.append((receipt, Path(_absolute_receipt_path(receipt.file_path))))
+
+    # Пропавшие файлы отсеиваем до отправки в пул: один просмотр на папку
+    # (обычно это одна папка чеков командировки), а не ошибка на каждый файл
+    names_by_dir = defaultdict(set)
+    for _, file_path in to_parse:
+        names_by_dir[file_path.parent].add(file_path.name)
+    present = {
+        folder / name
+        for folder, names in names_by_dir.items()
+        for name in _existing_files(folder, tuple(names))
+    }
+    missing = [file_path for _, file_path in to_parse if file_path not in present]
+    if missing:
+        logger.warning("[PARSE] %d receipt file(s) not found, e.g. %s", len(missing), missing[0])
+        to_parse = [item for item in to_parse if item[1] in present]
+
+    # Недавние неудачные попытки по неизменившимся файлам не повторяем
+    now = datetime.utcnow()
+    to_parse = [
+        (receipt, file_path) for receipt, file_path in to_parse
+        if not _parse_recently_attempted(receipt.parse_attempted_at, file_path, now)
+    ]
+
+    if not to_parse:
+        return
+
+    # Несколько файлов разбираем параллельно; результаты применяем в текущем потоке
+    paths = [file_path for _, file_path in to_parse]
+    if len(paths) == 1:
+        results = [_parse_receipt_file(paths[0])]
+    else:
+        results = list(_parse_pool.map(_parse_receipt_file, paths))
+
+    # Собираем изменения и пишем их одним executemany UPDATE по первичному ключу.
+    # Время попытки отмечаем у всех разобранных чеков, в том числе неудачных
+    updates = []
+
+    for (receipt, _), (qr_string, qr_data) in zip(to_parse, results):
+        values = {'id': receipt.id, 'parse_attempted_at': now}
+        updates.append(values)
         if not qr_data:
             continue
 
         amount = qr_data.get('amount')
         if amount is not None:
-            receipt.amount = amount
+            values['amount'] = amount
+            values['parse_warning'] = None
         if receipt.receipt_date is None and qr_data.get('date'):
-            receipt.receipt_date = qr_data.get('date')
+            values['receipt_date'] = qr_data.get('date')
 
         if qr_data.get('fn'):
-            receipt.fn = qr_data.get('fn')
+            values['fn'] = qr_data.get('fn')
         if qr_data.get('fd'):
-            receipt.fd = qr_data.get('fd')
+            values['fd'] = qr_data.get('fd')
         if qr_data.get('fp'):
-            receipt.fp = qr_data.get('fp')
+            values['fp'] = qr_data.get('fp')
         if qr_data.get('raw'):
-            receipt.qr_raw = qr_data.get('raw')
+            values['qr_raw'] = qr_data.get('raw')
 
         if qr_string:
-            receipt.has_qr = True
+            values['has_qr'] = True
 
-        updated = True
+    # executemany собирается только из подряд идущих строк с одинаковым набором
+    # колонок: группируем их, иначе чередование удачных и неудачных разборов
+    # дает по UPDATE на чек
+    updates.sort(key=sorted)
 
-    if updated:
-        db.commit()
-        for receipt in receipts:
-            db.refresh(receipt)
+    # Без refresh по каждому чеку: после commit командировка и ее чеки
+    # перечитываются при первом обращении двумя запросами, а не N
+    db.execute(update(Receipt), updates)
+    db.commit()
+
+
+class PerDiem(NamedTuple):
+    """Суточные по командировке: дни с коэффициентами, начислено, удержание за питание"""
+    days: float
+    total: float
+    deduction: float
+    to_pay: float
+    trip_days: int  # Календарные дни командировки
+
+
+@lru_cache(maxsize=1024)
+def _compute_per_diem(
+    date_from: date,
+    date_to: date,
+    departure_time: Optional[time],
+    arrival_time: Optional[time],
+    per_diem_rate: float,
+    meals_breakfast_count: int = 0,
+    meals_lunch_count: int = 0,
+    meals_dinner_count: int = 0
+) -> PerDiem:
+    """Единый расчет суточных для предпросмотров и генерации (аргументы хешируемые)"""
+    per_diem_days = calculate_per_diem_days(date_from, date_to, departure_time, arrival_time)
+    per_diem_total = per_diem_days * per_diem_rate
+    days = (date_to - date_from).days + 1
+    per_diem_deduction = (
+        meals_breakfast_count * 0.15 +
+        meals_lunch_count * 0.30 +
+        meals_dinner_count * 0.30
+    ) * per_diem_total / days if days > 0 else 0
+    return PerDiem(
+        days=per_diem_days,
+        total=per_diem_total,
+        deduction=per_diem_deduction,
+        to_pay=per_diem_total - per_diem_deduction,
+        trip_days=days
+    )
+
+
+class TripTotals(NamedTuple):
+    """Итоги по командировке: расходы по чекам, суточные, баланс аванса"""
+    expenses: Tuple[Tuple[str, float], ...]  # (категория, сумма) в порядке появления
+    per_diem_days: float
+    per_diem_total: float
+    per_diem_deduction: float
+    per_diem_to_pay: float
+    total_receipts_amount: float
+    total_expenses: float
+    to_return: float
+    trip_days: int
+
+    @property
+    def expenses_by_category(self) -> dict:
+        return dict(self.expenses)
+
+    def financials(self) -> dict:
+        """Финансовые поля в том виде, в каком их ждут генератор и предпросмотры"""
+        return {
+            'days': self.trip_days,
+            'expenses_by_category': self.expenses_by_category,
+            'per_diem_days': self.per_diem_days,
+            'per_diem_total': self.per_diem_total,
+            'per_diem_deduction': self.per_diem_deduction,
+            'per_diem_to_pay': self.per_diem_to_pay,
+            'total_receipts_amount': self.total_receipts_amount,
+            'total_expenses': self.total_expenses,
+            'to_return': self.to_return
+        }
+
+
+@lru_cache(maxsize=512)
+def _compute_trip_totals(
+    expense_items: Tuple[Tuple[str, float], ...],
+    date_from: date,
+    date_to: date,
+    departure_time: Optional[time],
+    arrival_time: Optional[time],
+    per_diem_rate: float,
+    meals_breakfast_count: int,
+    meals_lunch_count: int,
+    meals_dinner_count: int,
+    advance: float
+) -> TripTotals:
+    """
+    Чистый расчет итогов по командировке.
+
+    Аргументы хешируемые, поэтому повторные preview/generate с теми же
+    чеками и параметрами поездки берут результат из кеша.
+    """
+    # Расходы по категориям (один проход, один поиск в словаре на чек)
+    normalize = SimpleDocumentGenerator._normalize_category_key
+    expenses_by_category = defaultdict(int)
+    for category, amount in expense_items:
+        expenses_by_category[normalize(category)] += amount
+
+    # Суточные
+    per_diem = _compute_per_diem(
+        date_from, date_to, departure_time, arrival_time, per_diem_rate,
+        meals_breakfast_count, meals_lunch_count, meals_dinner_count
+    )
+
+    # Итоги
+    total_receipts_amount = sum(expenses_by_category.values())
+    total_expenses = total_receipts_amount + per_diem.to_pay
+    to_return = advance - total_expenses
+
+    return TripTotals(
+        expenses=tuple(expenses_by_category.items()),
+        per_diem_days=per_diem.days,
+        per_diem_total=per_diem.total,
+        per_diem_deduction=per_diem.deduction,
+        per_diem_to_pay=per_diem.to_pay,
+        total_receipts_amount=total_receipts_amount,
+        total_expenses=total_expenses,
+        to_return=to_return,
+        trip_days=per_diem.trip_days
+    )
+
+
+def _trip_totals(
+    trip: Trip,
+    user: User,
+    expense_items: Tuple[Tuple[str, float], ...],
+    advance: float
+) -> TripTotals:
+    """Итоги по командировке для переданных позиций расходов (через кеш)"""
+    return _compute_trip_totals(
+        expense_items,
+        trip.date_from,
+        trip.date_to,
+        trip.departure_time,
+        trip.arrival_time,
+        user.per_diem_rate,
+        trip.meals_breakfast_count,
+        trip.meals_lunch_count,
+        trip.meals_dinner_count,
+        advance
+    )
 
 
 class TripCreate(BaseModel):
@@ -133,9 +655,15 @@ class ReceiptInfo(BaseModel):
     org_name: Optional[str]
     file_name: str
     has_qr: bool
+    parse_warning: Optional[str] = None
+
+    model_config = ConfigDict(from_attributes=True)
 
-    class Config:
-        from_attributes = True
+    @computed_field
+    @property
+    def recognition_pending(self) -> bool:
+        """Сумма еще распознается в фоне после загрузки"""
+        return is_receipt_pending(self.id)
 
 
 class TripResponse(BaseModel):
@@ -162,391 +690,258 @@ class TripResponse(BaseModel):
     created_at: datetime
     receipts: List[ReceiptInfo] = []
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 @router.post("/", response_model=TripResponse, status_code=status.HTTP_201_CREATED)
-async def create_trip(
+def create_trip(
     trip_data: TripCreate,
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Создать новую командировку"""
 
+    # Пустой список чеков задаем сразу, чтобы ответ не загружал его отдельным SELECT
     new_trip = Trip(
         user_id=current_user.id,
+        receipts=[],
         **trip_data.model_dump()
     )
 
     db.add(new_trip)
+    # Ответ собираем после flush (id и created_at уже получены из INSERT),
+    # без refresh после commit
+    db.flush()
+    response = TripResponse.model_validate(new_trip)
     db.commit()
-    db.refresh(new_trip)
 
-    return new_trip
+    return response
+
+
+# Список командировок сериализуется одним проходом pydantic-core прямо в JSON:
+# без промежуточных dict и повторного кодирования в response_class
+_TRIP_LIST_ADAPTER = TypeAdapter(List[TripResponse])
 
 
 @router.get("/", response_model=List[TripResponse])
-async def get_trips(
+def get_trips(
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db),
     skip: int = 0,
-    limit: int = 100
+    limit: int = 100,
+    before_date: Optional[date] = None,
+    before_id: Optional[int] = None
 ):
-    """Получить список командировок текущего пользователя"""
+    """
+    Получить список командировок текущего пользователя.
 
-    trips = db.query(Trip).filter(
-        Trip.user_id == current_user.id
-    ).order_by(Trip.date_from.desc()).offset(skip).limit(limit).all()
+    Для следующей страницы передайте date_from и id последней командировки
+    в before_date/before_id (keyset-пагинация: без OFFSET, поиск по индексу).
+    skip оставлен для совместимости.
+    """
 
-    return trips
+    # Чеки всех командировок подгружаем одним запросом (без N+1 при сериализации)
+    query = db.query(Trip).options(*_WITH_RECEIPTS).filter(
+        Trip.user_id == current_user.id
+    )
+    query = query.order_by(Trip.date_from.desc(), Trip.id.desc())
+    if before_date is not None and before_id is not None:
+        query = query.filter(tuple_(Trip.date_from, Trip.id) < tuple_(before_date, before_id))
+    elif skip:
+        query = query.offset(skip)
+
+    trips = query.limit(limit).all()
+
+    return Response(
+        content=_TRIP_LIST_ADAPTER.dump_json(
+            _TRIP_LIST_ADAPTER.validate_python(trips, from_attributes=True)
+        ),
+        media_type="application/json"
+    )
 
 
 @router.get("/{trip_id}", response_model=TripResponse)
-async def get_trip(
-    trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+def get_trip(
+    trip: Trip = Depends(get_owned_trip_with_receipts)
 ):
     """Получить командировку по ID"""
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
-
-    # Lazy-обработка: если суммы не распознаны при загрузке, попробуем сейчас
-    _fill_missing_receipt_data(trip.receipts, db)
-
+    # Суммы распознаются в фоне при загрузке; пока распознавание идет, amount = None
     return trip
 
 
 @router.put("/{trip_id}", response_model=TripResponse)
-async def update_trip(
-    trip_id: int,
+def update_trip(
     trip_data: TripUpdate,
-    current_user: User = Depends(get_current_active_user),
+    trip: Trip = Depends(get_owned_trip),
     db: Session = Depends(get_db)
 ):
     """Обновить командировку"""
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
-
-    # Обновляем поля
-    update_data = trip_data.model_dump(exclude_unset=True)
-    for field, value in update_data.items():
-        setattr(trip, field, value)
-
-    db.commit()
-    db.refresh(trip)
+    # Обновляем только присланные поля одним UPDATE
+    update_data = {field: getattr(trip_data, field) for field in trip_data.model_fields_set}
+    if update_data:
+        db.execute(update(Trip).where(Trip.id == trip.id).values(**update_data))
+        db.commit()
 
+    # После commit командировка перечитается при сериализации ответа
     return trip
 
 
 @router.delete("/{trip_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_trip(
+def delete_trip(
     trip_id: int,
+    trip: Trip = Depends(get_owned_trip),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Удалить командировку"""
-    import shutil
-
-    logger.info(f"[DELETE] Starting deletion for trip_id={trip_id}, user={current_user.username}")
-
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
 
-    if not trip:
-        logger.error(f"[DELETE] Trip {trip_id} not found for user {current_user.username}")
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
+    logger.info("[DELETE] Starting deletion for trip_id=%s, user=%s", trip_id, current_user.username)
 
-    # Удаляем папку с чеками
-    receipts_dir = settings.UPLOAD_DIR / "receipts" / str(trip_id)
-    if receipts_dir.exists():
-        logger.info(f"[DELETE] Removing receipts directory: {receipts_dir}")
-        shutil.rmtree(receipts_dir)
-    else:
-        logger.debug(f"[DELETE] Receipts directory not found: {receipts_dir}")
-
-    # Удаляем папку с документами (проверяем обе директории)
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-
-    # Проверяем CUSTOM_OUTPUT_DIR
-    if settings.CUSTOM_OUTPUT_DIR:
-        custom_output_dir = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name
-        if custom_output_dir.exists():
-            logger.info(f"[DELETE] Removing custom output directory: {custom_output_dir}")
-            shutil.rmtree(custom_output_dir)
-
-        custom_zip_path = Path(settings.CUSTOM_OUTPUT_DIR) / f"{folder_name}.zip"
-        if custom_zip_path.exists():
-            logger.info(f"[DELETE] Removing custom ZIP archive: {custom_zip_path}")
-            custom_zip_path.unlink()
-
-    # Проверяем стандартную OUTPUT_DIR
-    output_dir = settings.OUTPUT_DIR / folder_name
-    if output_dir.exists():
-        logger.info(f"[DELETE] Removing output directory: {output_dir}")
-        shutil.rmtree(output_dir)
-    else:
-        logger.debug(f"[DELETE] Output directory not found: {output_dir}")
+    # Папка с чеками, папка с документами и ZIP архив (в обеих директориях документов):
+    # по одному просмотру каталога вместо exists() на каждый путь
+    forget_receipts_dir(trip_id)
+    with _post_trip_jobs_lock:
+        _post_trip_jobs.pop(trip_id, None)
+    paths = _trip_paths(trip)
+    doomed = {paths.folder_name, paths.zip_path.name}
+    targets = [(RECEIPTS_ROOT, {str(trip_id)}), (settings.OUTPUT_DIR, doomed)]
+    if _CUSTOM_OUTPUT_DIR:
+        targets.append((_CUSTOM_OUTPUT_DIR, doomed))
 
-    # Удаляем ZIP архив
-    zip_path = settings.OUTPUT_DIR / f"{folder_name}.zip"
-    if zip_path.exists():
-        logger.info(f"[DELETE] Removing ZIP archive: {zip_path}")
-        zip_path.unlink()
-    else:
-        logger.debug(f"[DELETE] ZIP archive not found: {zip_path}")
+    # Каталоги независимы - удаляем параллельно и дожидаемся всех (ошибки пробрасываются)
+    removals = [_cleanup_pool.submit(_remove_entries, parent, names) for parent, names in targets]
+    for removal in removals:
+        removal.result()
 
     # Удаляем запись из БД (каскадно удалятся чеки)
     db.delete(trip)
     db.commit()
 
-    logger.info(f"[DELETE] Trip {trip_id} successfully deleted")
+    logger.info("[DELETE] Trip %s successfully deleted", trip_id)
     return None
 
 
 @router.get("/{trip_id}/preview")
-async def preview_generation(
+def preview_generation(
     trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    trip: Trip = Depends(get_owned_trip_with_receipts),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Предпросмотр данных перед генерацией документов"""
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
+    # Коллекция уже загружена selectinload - берем ее один раз
+    receipts = trip.receipts
 
-    if not trip:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
-
-    # Lazy-обработка: добираем суммы/даты из файлов, если еще не распознаны
-    _fill_missing_receipt_data(trip.receipts, db)
-
-    # Рассчитываем расходы по категориям
-    expenses_by_category = {}
-    for receipt in trip.receipts:
-        category = SimpleDocumentGenerator._normalize_category_key(receipt.category)
-        if category not in expenses_by_category:
-            expenses_by_category[category] = 0
-        expenses_by_category[category] += receipt.amount or 0
-
-    # Рассчитываем суточные
-    per_diem_days = calculate_per_diem_days(
-        trip.date_from,
-        trip.date_to,
-        trip.departure_time,
-        trip.arrival_time
+    # Расходы по категориям и суточные (все чеки, включая нулевые)
+    totals = _trip_totals(
+        trip,
+        current_user,
+        tuple((r.category, r.amount or 0) for r in receipts),
+        trip.advance_rub
     )
 
-    per_diem_total = per_diem_days * current_user.per_diem_rate
-    days = (trip.date_to - trip.date_from).days + 1
-    per_diem_deduction = (
-        trip.meals_breakfast_count * 0.15 +
-        trip.meals_lunch_count * 0.30 +
-        trip.meals_dinner_count * 0.30
-    ) * per_diem_total / days if days > 0 else 0
-
-    per_diem_to_pay = per_diem_total - per_diem_deduction
-
-    # Общие расходы
-    total_receipts_amount = sum(expenses_by_category.values())
-    total_expenses = total_receipts_amount + per_diem_to_pay
-    to_return = trip.advance_rub - total_expenses
-
     # Проверка на ошибки
     warnings = []
     errors = []
 
-    if not trip.receipts or len(trip.receipts) == 0:
+    if not receipts:
         errors.append("Не загружено ни одного чека")
 
-    if total_receipts_amount == 0:
+    if totals.total_receipts_amount == 0:
         warnings.append("У всех чеков нулевая сумма")
 
     if not trip.departure_time or not trip.arrival_time:
         warnings.append("Не указано время выезда/приезда - суточные могут быть рассчитаны неправильно")
 
-    if total_expenses == 0:
+    if totals.total_expenses == 0:
         errors.append("Нет расходов для документов (ни чеки, ни суточные)")
 
     return {
         "trip_id": trip_id,
         "destination": trip.destination_city,
         "dates": f"{trip.date_from.strftime('%d.%m.%Y')} - {trip.date_to.strftime('%d.%m.%Y')}",
-        "receipts_count": len(trip.receipts),
-        "expenses_by_category": expenses_by_category,
-        "per_diem_days": per_diem_days,
-        "per_diem_total": per_diem_total,
-        "per_diem_deduction": per_diem_deduction,
-        "per_diem_to_pay": per_diem_to_pay,
-        "total_receipts_amount": total_receipts_amount,
-        "total_expenses": total_expenses,
+        "receipts_count": len(receipts),
+        **totals.financials(),
         "advance_rub": trip.advance_rub,
-        "to_return": to_return,
         "warnings": warnings,
         "errors": errors,
         "can_generate": len(errors) == 0
     }
 
 
+# def, а не async def: БД, файлы и ожидание генерации - в пуле потоков, не в event loop
 @router.post("/{trip_id}/generate")
-async def generate_documents(
+def generate_documents(
     trip_id: int,
+    trip: Trip = Depends(get_owned_trip_with_receipts),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Сгенерировать все документы для командировки"""
 
-    logger.info(f"[GENERATE] Starting generation for trip_id={trip_id}, user={current_user.username}")
+    logger.info("[GENERATE] Starting generation for trip_id=%s, user=%s, receipts=%d",
+                trip_id, current_user.username, len(trip.receipts))
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
+    # Lazy-обработка: добираем суммы/даты из файлов, если еще не распознаны
+    _fill_missing_receipt_data(trip.id, db)
 
-    if not trip:
-        logger.error(f"[GENERATE] Trip {trip_id} not found for user {current_user.username}")
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
+    # Берем коллекцию после lazy-обработки: commit в ней сбрасывает загруженные чеки
+    receipts = trip.receipts
 
-    logger.info(f"[GENERATE] Trip found: {trip.destination_city}, receipts: {len(trip.receipts)}")
+    try:
+        # ВАЛИДАЦИЯ: Проверяем что есть чеки
+        if not receipts:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="Невозможно создать документы без чеков. Загрузите хотя бы один чек."
+            )
 
-    # Lazy-обработка: добираем суммы/даты из файлов, если еще не распознаны
-    _fill_missing_receipt_data(trip.receipts, db)
+        # Один проход по чекам: данные для генератора и позиции расходов.
+        # Относительные пути сразу делаем абсолютными
+        receipts_data = []
+        expense_items = []
+        for r in receipts:
+            amount = r.amount
+            category = r.category
+            expense_items.append((category, amount or 0))
+            receipts_data.append({
+                'category': category,
+                'amount': amount,
+                'date': r.receipt_date,
+                'org_name': r.org_name,
+                'file_path': _absolute_receipt_path(r.file_path)
+            })
+        logger.debug("[GENERATE] %d receipt paths resolved", len(receipts_data))
+
+        # Расходы по категориям и суточные
+        totals = _trip_totals(trip, current_user, tuple(expense_items), trip.advance_rub)
+
+        # ВАЛИДАЦИЯ: Проверяем что есть суммы
+        if totals.total_receipts_amount == 0 and totals.per_diem_to_pay == 0:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="У всех чеков нулевая сумма и нет суточных. Отредактируйте чеки или добавьте информацию о времени выезда/приезда."
+            )
 
-    try:
         # Собираем данные для генерации
         trip_data = {
-            'fio': current_user.fio,
-            'tab_no': current_user.tab_no,
-            'department': current_user.department,
-            'position': current_user.position,
-            'org_name': current_user.org_name,
-            'destination_city': trip.destination_city,
-            'destination_org': trip.destination_org,
-            'date_from': trip.date_from,
-            'date_to': trip.date_to,
+            **_base_trip_data(trip, current_user),
             'departure_time': trip.departure_time,
             'arrival_time': trip.arrival_time,
-            'purpose': trip.purpose,
-            'days': (trip.date_to - trip.date_from).days + 1,
             'per_diem_rate': current_user.per_diem_rate,
             'meals_breakfast_count': trip.meals_breakfast_count,
             'meals_lunch_count': trip.meals_lunch_count,
             'meals_dinner_count': trip.meals_dinner_count,
             'advance_rub': trip.advance_rub,
-            'receipts': [
-                {
-                    'category': r.category,
-                    'amount': r.amount,
-                    'date': r.receipt_date,
-                    'org_name': r.org_name,
-                    'file_path': r.file_path
-                }
-                for r in trip.receipts
-            ]
+            'receipts': receipts_data,
+            **totals.financials()
         }
 
-        # Рассчитываем расходы по категориям
-        expenses_by_category = {}
-        for receipt in trip.receipts:
-            category = SimpleDocumentGenerator._normalize_category_key(receipt.category)
-            if category not in expenses_by_category:
-                expenses_by_category[category] = 0
-            expenses_by_category[category] += receipt.amount or 0
-
-        trip_data['expenses_by_category'] = expenses_by_category
-
-        # Рассчитываем суточные
-        per_diem_days = calculate_per_diem_days(
-            trip.date_from,
-            trip.date_to,
-            trip.departure_time,
-            trip.arrival_time
-        )
-
-        per_diem_total = per_diem_days * current_user.per_diem_rate
-        per_diem_deduction = (
-            trip.meals_breakfast_count * 0.15 +
-            trip.meals_lunch_count * 0.30 +
-            trip.meals_dinner_count * 0.30
-        ) * per_diem_total / trip_data['days'] if trip_data['days'] > 0 else 0
-
-        per_diem_to_pay = per_diem_total - per_diem_deduction
-
-        # Общие расходы
-        total_expenses = sum(expenses_by_category.values()) + per_diem_to_pay
-        to_return = trip.advance_rub - total_expenses
-
-        trip_data.update({
-            'per_diem_days': per_diem_days,
-            'per_diem_total': per_diem_total,
-            'per_diem_deduction': per_diem_deduction,
-            'per_diem_to_pay': per_diem_to_pay,
-            'total_expenses': total_expenses,
-            'to_return': to_return
-        })
-
-        # ВАЛИДАЦИЯ: Проверяем что есть чеки с суммами
-        if not trip.receipts or len(trip.receipts) == 0:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Невозможно создать документы без чеков. Загрузите хотя бы один чек."
-            )
-
-        total_amount = sum(r.amount or 0 for r in trip.receipts)
-        if total_amount == 0 and per_diem_to_pay == 0:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="У всех чеков нулевая сумма и нет суточных. Отредактируйте чеки или добавьте информацию о времени выезда/приезда."
-            )
-
-        # Преобразуем относительные пути в абсолютные для генератора
-        logger.info(f"[GENERATE] Converting receipt paths to absolute")
-        for receipt in trip_data['receipts']:
-            if 'file_path' in receipt:
-                rel_path = Path(receipt['file_path'])
-                if not rel_path.is_absolute():
-                    receipt['file_path'] = str(settings.BASE_DIR / rel_path)
-                logger.info(f"[GENERATE]   Receipt: {receipt['file_path']}")
-
         # Генерируем документы упрощенным генератором
-        logger.info(f"[GENERATE] Creating SimpleDocumentGenerator")
-        generator = SimpleDocumentGenerator(settings.TEMPLATES_DIR, settings.OUTPUT_DIR)
-
-        logger.info(f"[GENERATE] Calling generator.generate_all()")
-        result = generator.generate_all(trip_data)
-        logger.info(f"[GENERATE] Generation successful: {result}")
+        result = _generate_in_process('generate_all', trip_data)
+        logger.info("[GENERATE] Generation successful: %s", result)
         return {
             "message": "Documents generated successfully",
             "files": result
@@ -555,7 +950,7 @@ async def generate_documents(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"[GENERATE] Generation failed: {e}", exc_info=True)
+        logger.error("[GENERATE] Generation failed: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error generating documents: {str(e)}"
@@ -565,28 +960,18 @@ async def generate_documents(
 # ==================== ЭТАП 1: ДО ПОЕЗДКИ ====================
 
 @router.get("/{trip_id}/preview-pre-trip")
-async def preview_pre_trip(
+def preview_pre_trip(
     trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    trip: Trip = Depends(get_owned_trip),
+    current_user: User = Depends(get_current_active_user)
 ):
     """Предпросмотр данных ДО поездки (для Приказа и СЗ на аванс)"""
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    days = (trip.date_to - trip.date_from).days + 1
-
-    # Рассчитываем суточные
-    per_diem_days = calculate_per_diem_days(
-        trip.date_from, trip.date_to, trip.departure_time, trip.arrival_time
+    # Рассчитываем суточные (до поездки - без удержаний за питание)
+    per_diem = _compute_per_diem(
+        trip.date_from, trip.date_to, trip.departure_time, trip.arrival_time,
+        current_user.per_diem_rate
     )
-    per_diem_total = per_diem_days * current_user.per_diem_rate
 
     # Предполагаемые расходы = аванс
     advance = trip.advance_rub or 0
@@ -598,20 +983,9 @@ async def preview_pre_trip(
         warnings.append("Время выезда/приезда не указано")
 
     # Проверяем существование документов (защита от дубликатов)
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-    if settings.CUSTOM_OUTPUT_DIR:
-        docs_path = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name / "documents"
-    else:
-        docs_path = settings.OUTPUT_DIR / folder_name / "documents"
-
-    files_exist = []
-    prikaz_path = docs_path / "Приказ.docx"
-    sz_path = docs_path / "Служебная_записка_аванс.docx"
+    docs_path = _trip_paths(trip).docs_path
 
-    if prikaz_path.exists():
-        files_exist.append("Приказ.docx")
-    if sz_path.exists():
-        files_exist.append("Служебная_записка_аванс.docx")
+    files_exist = _existing_files(docs_path, ("Приказ.docx", "Служебная_записка_аванс.docx"))
 
     if files_exist:
         warnings.append(f"Документы уже существуют: {', '.join(files_exist)}. При повторной генерации они будут перезаписаны.")
@@ -621,11 +995,11 @@ async def preview_pre_trip(
         "destination": trip.destination_city,
         "destination_org": trip.destination_org,
         "dates": f"{trip.date_from.strftime('%d.%m.%Y')} - {trip.date_to.strftime('%d.%m.%Y')}",
-        "days": days,
+        "days": per_diem.trip_days,
         "purpose": trip.purpose,
         "advance_rub": advance,
-        "per_diem_days": per_diem_days,
-        "per_diem_total": per_diem_total,
+        "per_diem_days": per_diem.days,
+        "per_diem_total": per_diem.total,
         "prikaz_date": (trip.prikaz_date or date.today()).strftime('%d.%m.%Y'),
         "sz_date": (trip.sz_date or date.today()).strftime('%d.%m.%Y'),
         "pre_trip_docs_generated": trip.pre_trip_docs_generated,
@@ -636,8 +1010,9 @@ async def preview_pre_trip(
 
 
 @router.post("/{trip_id}/generate-pre-trip")
-async def generate_pre_trip_documents(
+def generate_pre_trip_documents(
     trip_id: int,
+    trip: Trip = Depends(get_owned_trip),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
@@ -646,30 +1021,13 @@ async def generate_pre_trip_documents(
     - Приказ (дата = prikaz_date или сегодня)
     - Служебная записка на аванс (сумма = advance_rub)
     """
-    logger.info(f"[PRE-TRIP] Starting generation for trip_id={trip_id}")
-
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
+    logger.info("[PRE-TRIP] Starting generation for trip_id=%s", trip_id)
 
     try:
         trip_data = {
-            'fio': current_user.fio,
-            'tab_no': current_user.tab_no,
-            'department': current_user.department,
-            'position': current_user.position,
-            'org_name': current_user.org_name,
-            'destination_city': trip.destination_city,
-            'destination_org': trip.destination_org,
-            'date_from': trip.date_from,
-            'date_to': trip.date_to,
+            **_base_trip_data(trip, current_user),
             'departure_time': trip.departure_time,
             'arrival_time': trip.arrival_time,
-            'purpose': trip.purpose,
             'days': (trip.date_to - trip.date_from).days + 1,
             'advance_rub': trip.advance_rub or 0,
             'prikaz_date': trip.prikaz_date or date.today(),
@@ -677,13 +1035,11 @@ async def generate_pre_trip_documents(
         }
 
         # Определяем директорию для сохранения
-        custom_dir = None
-        if settings.CUSTOM_OUTPUT_DIR:
-            custom_dir = Path(settings.CUSTOM_OUTPUT_DIR)
+        custom_dir = _CUSTOM_OUTPUT_DIR
+        if custom_dir:
             custom_dir.mkdir(parents=True, exist_ok=True)
 
-        generator = SimpleDocumentGenerator(settings.TEMPLATES_DIR, settings.OUTPUT_DIR)
-        result = generator.generate_pre_trip(trip_data, custom_output_dir=custom_dir)
+        result = _generate_in_process('generate_pre_trip', trip_data, custom_output_dir=custom_dir)
 
         # Обновляем флаг в БД
         trip.pre_trip_docs_generated = True
@@ -691,7 +1047,7 @@ async def generate_pre_trip_documents(
             trip.status = TripStatus.PLANNED  # Остаётся planned
         db.commit()
 
-        logger.info(f"[PRE-TRIP] Generation successful: {result}")
+        logger.info("[PRE-TRIP] Generation successful: %s", result)
         return {
             "message": "Документы ДО поездки успешно созданы",
             "files": result,
@@ -700,7 +1056,7 @@ async def generate_pre_trip_documents(
         }
 
     except Exception as e:
-        logger.error(f"[PRE-TRIP] Generation failed: {e}", exc_info=True)
+        logger.error("[PRE-TRIP] Generation failed: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка генерации: {str(e)}"
@@ -710,59 +1066,35 @@ async def generate_pre_trip_documents(
 # ==================== ЭТАП 2: ПОСЛЕ ПОЕЗДКИ ====================
 
 @router.get("/{trip_id}/preview-post-trip")
-async def preview_post_trip(
+def preview_post_trip(
     trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    trip: Trip = Depends(get_owned_trip_with_receipts),
+    current_user: User = Depends(get_current_active_user)
 ):
     """
     Предпросмотр данных ПОСЛЕ поездки (для АО и СЗ на доплату).
     Показывает: сумма чеков, суточные, итого, к возврату/доплате.
     """
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    # Lazy-обработка чеков
-    _fill_missing_receipt_data(trip.receipts, db)
-
-    # Расходы по категориям (только документы с суммой)
-    expenses_by_category = {}
-    for receipt in trip.receipts:
-        if receipt.requires_amount and receipt.amount:
-            category = SimpleDocumentGenerator._normalize_category_key(receipt.category)
-            expenses_by_category[category] = expenses_by_category.get(category, 0) + receipt.amount
+    # Коллекция уже загружена selectinload - берем ее один раз
+    receipts = trip.receipts
+    receipts_with_amount = [r for r in receipts if r.requires_amount]
 
-    # Суточные
-    days = (trip.date_to - trip.date_from).days + 1
-    per_diem_days = calculate_per_diem_days(
-        trip.date_from, trip.date_to, trip.departure_time, trip.arrival_time
-    )
-    per_diem_total = per_diem_days * current_user.per_diem_rate
-    per_diem_deduction = (
-        trip.meals_breakfast_count * 0.15 +
-        trip.meals_lunch_count * 0.30 +
-        trip.meals_dinner_count * 0.30
-    ) * per_diem_total / days if days > 0 else 0
-    per_diem_to_pay = per_diem_total - per_diem_deduction
-
-    # Итоги
-    total_receipts = sum(expenses_by_category.values())
-    total_expenses = total_receipts + per_diem_to_pay
+    # Расходы по категориям (только документы с суммой) и суточные
     advance = trip.advance_rub or 0
-    to_return = advance - total_expenses  # >0 = вернуть, <0 = доплатить
+    totals = _trip_totals(
+        trip,
+        current_user,
+        tuple((r.category, r.amount) for r in receipts_with_amount if r.amount),
+        advance
+    )
+    to_return = totals.to_return  # >0 = вернуть, <0 = доплатить
 
     warnings = []
     errors = []
 
-    receipts_with_amount = [r for r in trip.receipts if r.requires_amount]
     if not receipts_with_amount:
         errors.append("Нет чеков с суммами")
-    elif total_receipts == 0:
+    elif totals.total_receipts_amount == 0:
         warnings.append("У всех чеков нулевая сумма")
 
     if not trip.departure_time or not trip.arrival_time:
@@ -772,20 +1104,9 @@ async def preview_post_trip(
     needs_sz_dopay = to_return < 0
 
     # Проверяем существование документов (защита от дубликатов)
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-    if settings.CUSTOM_OUTPUT_DIR:
-        docs_path = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name / "documents"
-    else:
-        docs_path = settings.OUTPUT_DIR / folder_name / "documents"
-
-    files_exist = []
-    ao_path = docs_path / "Авансовый_отчет.xlsx"
-    sz_dopay_path = docs_path / "Служебная_записка_доплата.docx"
+    docs_path = _trip_paths(trip).docs_path
 
-    if ao_path.exists():
-        files_exist.append("Авансовый_отчет.xlsx")
-    if sz_dopay_path.exists():
-        files_exist.append("Служебная_записка_доплата.docx")
+    files_exist = _existing_files(docs_path, ("Авансовый_отчет.xlsx", "Служебная_записка_доплата.docx"))
 
     if files_exist:
         warnings.append(f"Документы уже существуют: {', '.join(files_exist)}. При повторной генерации они будут перезаписаны.")
@@ -794,17 +1115,10 @@ async def preview_post_trip(
         "trip_id": trip_id,
         "destination": trip.destination_city,
         "dates": f"{trip.date_from.strftime('%d.%m.%Y')} - {trip.date_to.strftime('%d.%m.%Y')}",
-        "receipts_count": len(trip.receipts),
+        "receipts_count": len(receipts),
         "receipts_with_amount_count": len(receipts_with_amount),
-        "expenses_by_category": expenses_by_category,
-        "per_diem_days": per_diem_days,
-        "per_diem_total": per_diem_total,
-        "per_diem_deduction": per_diem_deduction,
-        "per_diem_to_pay": per_diem_to_pay,
-        "total_receipts_amount": total_receipts,
-        "total_expenses": total_expenses,
+        **totals.financials(),
         "advance_rub": advance,
-        "to_return": to_return,
         "needs_sz_dopay": needs_sz_dopay,
         "balance_status": "К возврату" if to_return > 0 else ("К доплате" if to_return < 0 else "В ноль"),
         "ao_date": (trip.ao_date or date.today()).strftime('%d.%m.%Y'),
@@ -817,8 +1131,12 @@ async def preview_post_trip(
 
 
 @router.post("/{trip_id}/generate-post-trip")
-async def generate_post_trip_documents(
+def generate_post_trip_documents(
     trip_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    background: bool = False,
+    trip: Trip = Depends(get_owned_trip_with_receipts),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
@@ -826,22 +1144,20 @@ async def generate_post_trip_documents(
     Генерирует документы ПОСЛЕ поездки:
     - Авансовый отчёт
     - Служебная записка на доплату (ТОЛЬКО если перерасход > 0)
-    """
-    logger.info(f"[POST-TRIP] Starting generation for trip_id={trip_id}")
-
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
 
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
+    background=true: генерация идет после ответа (202 Accepted),
+    результат - через GET /{trip_id}/generation-status.
+    """
+    logger.info("[POST-TRIP] Starting generation for trip_id=%s", trip_id)
 
     # Lazy-обработка чеков
-    _fill_missing_receipt_data(trip.receipts, db)
+    _fill_missing_receipt_data(trip.id, db)
+
+    # Берем коллекцию после lazy-обработки: commit в ней сбрасывает загруженные чеки
+    receipts = trip.receipts
 
     # Проверка: есть ли чеки с суммами
-    receipts_with_amount = [r for r in trip.receipts if r.requires_amount and r.amount]
+    receipts_with_amount = [r for r in receipts if r.requires_amount and r.amount]
     if not receipts_with_amount:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -849,86 +1165,61 @@ async def generate_post_trip_documents(
         )
 
     try:
-        # Расходы по категориям
-        expenses_by_category = {}
-        for receipt in trip.receipts:
-            if receipt.requires_amount and receipt.amount:
-                category = SimpleDocumentGenerator._normalize_category_key(receipt.category)
-                expenses_by_category[category] = expenses_by_category.get(category, 0) + receipt.amount
-
-        # Суточные
-        days = (trip.date_to - trip.date_from).days + 1
-        per_diem_days = calculate_per_diem_days(
-            trip.date_from, trip.date_to, trip.departure_time, trip.arrival_time
+        # Расходы по категориям и суточные
+        totals = _trip_totals(
+            trip,
+            current_user,
+            tuple((r.category, r.amount) for r in receipts_with_amount),
+            trip.advance_rub or 0
         )
-        per_diem_total = per_diem_days * current_user.per_diem_rate
-        per_diem_deduction = (
-            trip.meals_breakfast_count * 0.15 +
-            trip.meals_lunch_count * 0.30 +
-            trip.meals_dinner_count * 0.30
-        ) * per_diem_total / days if days > 0 else 0
-        per_diem_to_pay = per_diem_total - per_diem_deduction
-
-        total_expenses = sum(expenses_by_category.values()) + per_diem_to_pay
-        to_return = (trip.advance_rub or 0) - total_expenses
 
         trip_data = {
-            'fio': current_user.fio,
-            'tab_no': current_user.tab_no,
-            'department': current_user.department,
-            'position': current_user.position,
-            'org_name': current_user.org_name,
-            'destination_city': trip.destination_city,
-            'destination_org': trip.destination_org,
-            'date_from': trip.date_from,
-            'date_to': trip.date_to,
-            'purpose': trip.purpose,
-            'days': days,
+            **_base_trip_data(trip, current_user),
             'advance_rub': trip.advance_rub or 0,
             'ao_date': trip.ao_date or date.today(),
-            'expenses_by_category': expenses_by_category,
-            'per_diem_days': per_diem_days,
-            'per_diem_total': per_diem_total,
-            'per_diem_deduction': per_diem_deduction,
-            'per_diem_to_pay': per_diem_to_pay,
-            'total_expenses': total_expenses,
-            'to_return': to_return,
+            **totals.financials(),
             'receipts': [
                 {
                     'category': r.category,
                     'amount': r.amount,
                     'date': r.receipt_date,
                     'org_name': r.org_name,
-                    'file_path': str(settings.BASE_DIR / r.file_path) if not Path(r.file_path).is_absolute() else r.file_path
+                    'file_path': _absolute_receipt_path(r.file_path)
                 }
-                for r in trip.receipts
+                for r in receipts
             ]
         }
 
         # Определяем директорию для сохранения
-        custom_dir = None
-        if settings.CUSTOM_OUTPUT_DIR:
-            custom_dir = Path(settings.CUSTOM_OUTPUT_DIR)
+        custom_dir = _CUSTOM_OUTPUT_DIR
+        if custom_dir:
             custom_dir.mkdir(parents=True, exist_ok=True)
 
-        generator = SimpleDocumentGenerator(settings.TEMPLATES_DIR, settings.OUTPUT_DIR)
-        result = generator.generate_post_trip(trip_data, custom_output_dir=custom_dir)
+        if background:
+            with _post_trip_jobs_lock:
+                if _post_trip_jobs.get(trip.id, {}).get("status") == "generating":
+                    raise HTTPException(
+                        status_code=status.HTTP_409_CONFLICT,
+                        detail="Документы уже создаются"
+                    )
+                _post_trip_jobs[trip.id] = {"status": "generating"}
+            background_tasks.add_task(_generate_post_trip_background, trip.id, trip_data, custom_dir)
+            response.status_code = status.HTTP_202_ACCEPTED
+            return {"message": "Создание документов ПОСЛЕ поездки запущено", "status": "generating"}
+
+        result = _generate_in_process('generate_post_trip', trip_data, custom_output_dir=custom_dir)
 
         # Обновляем флаг в БД
         trip.post_trip_docs_generated = True
         trip.status = TripStatus.REPORTED
         db.commit()
 
-        documents = ["Авансовый отчёт"]
-        if result.get('needs_sz_dopay'):
-            documents.append("Служебная записка (доплата)")
-
-        logger.info(f"[POST-TRIP] Generation successful: {result}")
+        logger.info("[POST-TRIP] Generation successful: %s", result)
         return {
             "message": "Документы ПОСЛЕ поездки успешно созданы",
             "files": result,
-            "documents": documents,
-            "to_return": to_return,
+            "documents": _post_trip_documents(result),
+            "to_return": totals.to_return,
             "needs_sz_dopay": result.get('needs_sz_dopay', False),
             "folder": result.get('folder', '')
         }
@@ -936,41 +1227,45 @@ async def generate_post_trip_documents(
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"[POST-TRIP] Generation failed: {e}", exc_info=True)
+        logger.error("[POST-TRIP] Generation failed: %s", e, exc_info=True)
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка генерации: {str(e)}"
         )
 
 
+@router.get("/{trip_id}/generation-status")
+def get_post_trip_generation_status(
+    trip_id: int,
+    trip: Trip = Depends(get_owned_trip)
+):
+    """
+    Состояние фоновой генерации документов после поездки.
+
+    status: generating, done, failed; idle - генерация в этом процессе
+    сервера не запускалась (тогда done/idle берется из флага командировки).
+    """
+    with _post_trip_jobs_lock:
+        job = _post_trip_jobs.get(trip.id)
+    if job is not None:
+        return job
+    return {
+        "status": "done" if trip.post_trip_docs_generated else "idle",
+        "files": {},
+        "needs_sz_dopay": False
+    }
+
+
 # ==================== СКАЧИВАНИЕ ====================
 
 @router.get("/{trip_id}/download")
-async def download_trip_package(
-    trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+def download_trip_package(
+    trip: Trip = Depends(get_owned_trip)
 ):
     """Скачать ZIP архив с документами командировки"""
 
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Trip not found"
-        )
-
     # Путь к ZIP файлу - используем CUSTOM_OUTPUT_DIR если указан
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-
-    if settings.CUSTOM_OUTPUT_DIR:
-        zip_path = Path(settings.CUSTOM_OUTPUT_DIR) / f"{folder_name}.zip"
-    else:
-        zip_path = settings.OUTPUT_DIR / f"{folder_name}.zip"
+    zip_path = _trip_paths(trip).zip_path
 
     if not zip_path.exists():
         raise HTTPException(
@@ -978,19 +1273,13 @@ async def download_trip_package(
             detail="Documents not generated yet. Please generate them first."
         )
 
-    return FileResponse(
-        path=zip_path,
-        media_type='application/zip',
-        filename=f"{folder_name}.zip"
-    )
+    return _file_response(zip_path, zip_path.name, 'application/zip')
 
 
 @router.get("/{trip_id}/download-file/{file_type}")
-async def download_single_file(
-    trip_id: int,
+def download_single_file(
     file_type: str,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    trip: Trip = Depends(get_owned_trip)
 ):
     """
     Скачать отдельный файл:
@@ -999,23 +1288,8 @@ async def download_single_file(
     - ao: Авансовый_отчет.xlsx
     - sz_dopay: Служебная_записка_доплата.docx
     """
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-
     # Используем CUSTOM_OUTPUT_DIR если указан, иначе OUTPUT_DIR
-    if settings.CUSTOM_OUTPUT_DIR:
-        base_path = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name / "documents"
-    else:
-        base_path = settings.OUTPUT_DIR / folder_name / "documents"
-
-    logger.info(f"[DOWNLOAD] Looking for file in: {base_path}")
+    base_path = _trip_paths(trip).docs_path
 
     file_map = {
         'prikaz': ('Приказ.docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
@@ -1031,80 +1305,50 @@ async def download_single_file(
     filename, media_type = file_map[file_type]
     file_path = base_path / filename
 
-    logger.info(f"[DOWNLOAD] File path: {file_path}, exists: {file_path.exists()}")
+    file_exists = file_path.exists()
+    logger.debug("[DOWNLOAD] File path: %s, exists: %s", file_path, file_exists)
 
-    if not file_path.exists():
+    if not file_exists:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"File not found: {filename}. Path: {file_path}. Generate documents first."
         )
 
-    return FileResponse(
-        path=str(file_path),
-        media_type=media_type,
-        filename=filename
-    )
+    return _file_response(file_path, filename, media_type)
 
 
 @router.get("/{trip_id}/download-pre-trip")
-async def download_pre_trip_files(
-    trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+def download_pre_trip_files(
+    trip: Trip = Depends(get_owned_trip)
 ):
     """
     Скачать оба файла ДО поездки (Приказ + СЗ) как ZIP архив.
     """
-    import zipfile
-    import tempfile
-
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
+    paths = _trip_paths(trip)
+    folder_name = paths.folder_name
 
     # Используем CUSTOM_OUTPUT_DIR если указан
-    if settings.CUSTOM_OUTPUT_DIR:
-        base_path = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name / "documents"
-    else:
-        base_path = settings.OUTPUT_DIR / folder_name / "documents"
+    base_path = paths.docs_path
 
-    files_to_zip = [
-        ('Приказ.docx', base_path / 'Приказ.docx'),
-        ('Служебная_записка_аванс.docx', base_path / 'Служебная_записка_аванс.docx'),
-    ]
+    names = ('Приказ.docx', 'Служебная_записка_аванс.docx')
+    files_to_zip = [(name, str(base_path / name)) for name in names]
 
-    # Проверяем что файлы существуют
-    missing_files = [name for name, path in files_to_zip if not path.exists()]
+    # Проверяем что файлы существуют (один просмотр папки)
+    present = _existing_files(base_path, names)
+    missing_files = [name for name in names if name not in present]
     if missing_files:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Файлы не найдены: {', '.join(missing_files)}. Сгенерируйте документы."
         )
 
-    # Создаем временный ZIP
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp:
-        with zipfile.ZipFile(tmp.name, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for name, path in files_to_zip:
-                zf.write(path, name)
-
-        return FileResponse(
-            path=tmp.name,
-            media_type='application/zip',
-            filename=f"{folder_name}_ДО_поездки.zip"
-        )
+    # ZIP собирается на лету и уходит клиенту по частям
+    return _zip_response(files_to_zip, f"{folder_name}_ДО_поездки.zip")
 
 
 @router.get("/{trip_id}/download-post-trip")
-async def download_post_trip_files(
-    trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+def download_post_trip_files(
+    trip: Trip = Depends(get_owned_trip)
 ):
     """
     Скачать файлы ПОСЛЕ поездки:
@@ -1112,63 +1356,39 @@ async def download_post_trip_files(
     - СЗ на доплату (если есть)
     - ZIP архив чеков
     """
-    import zipfile
-    import tempfile
-
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
+    paths = _trip_paths(trip)
+    folder_name = paths.folder_name
 
     # Используем CUSTOM_OUTPUT_DIR если указан
-    if settings.CUSTOM_OUTPUT_DIR:
-        base_path = Path(settings.CUSTOM_OUTPUT_DIR) / folder_name
-    else:
-        base_path = settings.OUTPUT_DIR / folder_name
-
-    docs_path = base_path / "documents"
-    receipts_path = base_path / "receipts"
+    docs_path = paths.docs_path
+    receipts_path = paths.receipts_path
 
     # Собираем файлы для архива
     files_to_zip = []
 
+    # Документы проверяем одним просмотром папки
+    present = _existing_files(docs_path, ('Авансовый_отчет.xlsx', 'Служебная_записка_доплата.docx'))
+
     # АО обязателен
-    ao_path = docs_path / 'Авансовый_отчет.xlsx'
-    if ao_path.exists():
-        files_to_zip.append(('documents/Авансовый_отчет.xlsx', ao_path))
-    else:
+    if 'Авансовый_отчет.xlsx' not in present:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Авансовый отчёт не найден. Сгенерируйте документы."
         )
+    for name in present:
+        files_to_zip.append((f'documents/{name}', str(docs_path / name)))
 
-    # СЗ на доплату (опционально)
-    sz_dopay_path = docs_path / 'Служебная_записка_доплата.docx'
-    if sz_dopay_path.exists():
-        files_to_zip.append(('documents/Служебная_записка_доплата.docx', sz_dopay_path))
-
-    # Чеки в папке receipts
-    if receipts_path.exists():
-        for receipt_file in receipts_path.iterdir():
-            if receipt_file.is_file():
-                files_to_zip.append((f'receipts/{receipt_file.name}', receipt_file))
-
-    # Создаем временный ZIP
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp:
-        with zipfile.ZipFile(tmp.name, 'w', zipfile.ZIP_DEFLATED) as zf:
-            for arc_name, path in files_to_zip:
-                zf.write(path, arc_name)
-
-        return FileResponse(
-            path=tmp.name,
-            media_type='application/zip',
-            filename=f"{folder_name}_ПОСЛЕ_поездки.zip"
-        )
+    # Чеки в папке receipts (тип файла берется из DirEntry, без stat на каждый)
+    try:
+        with os.scandir(receipts_path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    files_to_zip.append((f'receipts/{entry.name}', entry.path))
+    except FileNotFoundError:
+        pass
+
+    # ZIP собирается на лету и уходит клиенту по частям
+    return _zip_response(files_to_zip, f"{folder_name}_ПОСЛЕ_поездки.zip")
 
 
 # ==================== НАСТРОЙКИ ПОЛЬЗОВАТЕЛЯ ====================
@@ -1178,30 +1398,14 @@ class UserOutputDirUpdate(BaseModel):
 
 
 @router.get("/{trip_id}/folder-path")
-async def get_trip_folder_path(
-    trip_id: int,
-    current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+def get_trip_folder_path(
+    trip: Trip = Depends(get_owned_trip)
 ):
     """Получить путь к папке командировки"""
-    trip = db.query(Trip).filter(
-        Trip.id == trip_id,
-        Trip.user_id == current_user.id
-    ).first()
-
-    if not trip:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Trip not found")
-
-    folder_name = f"{trip.date_from.strftime('%Y-%m-%d')}_{trip.destination_city}"
-
-    # Используем CUSTOM_OUTPUT_DIR если указан
-    if settings.CUSTOM_OUTPUT_DIR:
-        actual_path = str(Path(settings.CUSTOM_OUTPUT_DIR) / folder_name)
-    else:
-        actual_path = str(settings.OUTPUT_DIR / folder_name)
+    paths = _trip_paths(trip)
 
     return {
-        "folder_name": folder_name,
-        "path": actual_path,
+        "folder_name": paths.folder_name,
+        "path": str(paths.base_path),
         "custom_output_dir": settings.CUSTOM_OUTPUT_DIR or None
     }
@@ -2,8 +2,9 @@
 API endpoints для управления пользователями
 """
 from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from sqlalchemy import update
 from sqlalchemy.orm import Session
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from ..database import get_db
 from ..models.user import User
 from ..utils.auth import get_current_active_user
@@ -13,6 +14,16 @@ import shutil
 
 router = APIRouter()
 
+# Буфер копирования подписи: файл подписи (обычно сотни КБ) переносится
+# за одно-два чтения вместо десятков по 64 КБ
+SIGNATURE_COPY_BYTES = 1024 * 1024
+
+ALLOWED_SIGNATURE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg'})
+ALLOWED_SIGNATURE_EXTENSIONS_TEXT = ', '.join(sorted(ALLOWED_SIGNATURE_EXTENSIONS))
+
+# Папку подписей создает settings.ensure_dirs() (при импорте app.main), а не каждая загрузка
+SIGNATURES_DIR = settings.UPLOAD_DIR / "signatures"
+
 
 class UserProfile(BaseModel):
     id: int
@@ -27,8 +38,7 @@ class UserProfile(BaseModel):
     per_diem_rate: int
     signature_path: str | None
 
-    class Config:
-        from_attributes = True
+    model_config = ConfigDict(from_attributes=True)
 
 
 class UserUpdate(BaseModel):
@@ -48,37 +58,29 @@ async def get_current_user_profile(current_user: User = Depends(get_current_acti
 
 
 @router.put("/me", response_model=UserProfile)
-async def update_current_user_profile(
+def update_current_user_profile(
     user_data: UserUpdate,
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
     """Обновить профиль текущего пользователя"""
 
-    # Обновляем поля
-    if user_data.fio is not None:
-        current_user.fio = user_data.fio
-    if user_data.tab_no is not None:
-        current_user.tab_no = user_data.tab_no
-    if user_data.department is not None:
-        current_user.department = user_data.department
-    if user_data.position is not None:
-        current_user.position = user_data.position
-    if user_data.org_name is not None:
-        current_user.org_name = user_data.org_name
-    if user_data.departure_city is not None:
-        current_user.departure_city = user_data.departure_city
-    if user_data.per_diem_rate is not None:
-        current_user.per_diem_rate = user_data.per_diem_rate
+    # Профиль собираем до commit из уже загруженных полей - без refresh
+    profile = UserProfile.model_validate(current_user)
 
-    db.commit()
-    db.refresh(current_user)
+    # Обновляем присланные (не пустые) поля одним UPDATE
+    update_data = user_data.model_dump(exclude_none=True)
+    if update_data:
+        db.execute(update(User).where(User.id == current_user.id).values(**update_data))
+        db.commit()
+        profile = profile.model_copy(update=update_data)
 
-    return current_user
+    return profile
 
 
+# def, а не async def: запись файла и commit идут в пуле потоков, не блокируя event loop
 @router.post("/me/signature")
-async def upload_signature(
+def upload_signature(
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
@@ -86,24 +88,26 @@ async def upload_signature(
     """Загрузить изображение подписи"""
 
     # Проверяем формат файла
-    allowed_extensions = ['.png', '.jpg', '.jpeg']
     file_extension = Path(file.filename).suffix.lower()
 
-    if file_extension not in allowed_extensions:
+    if file_extension not in ALLOWED_SIGNATURE_EXTENSIONS:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
-            detail=f"Only {', '.join(allowed_extensions)} files are allowed"
+            detail=f"Only {ALLOWED_SIGNATURE_EXTENSIONS_TEXT} files are allowed"
         )
 
     # Сохраняем файл
-    signatures_dir = settings.UPLOAD_DIR / "signatures"
-    signatures_dir.mkdir(exist_ok=True)
-
     filename = f"signature_{current_user.id}{file_extension}"
-    file_path = signatures_dir / filename
-
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    file_path = SIGNATURES_DIR / filename
+
+    try:
+        buffer = open(file_path, "wb")
+    except FileNotFoundError:
+        # Папку удалили во время работы сервера - создаем заново
+        SIGNATURES_DIR.mkdir(parents=True, exist_ok=True)
+        buffer = open(file_path, "wb")
+    with buffer:
+        shutil.copyfileobj(file.file, buffer, SIGNATURE_COPY_BYTES)
 
     # Обновляем путь в БД
     current_user.signature_path = str(file_path)
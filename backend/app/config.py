@@ -32,14 +32,15 @@ class Settings(BaseSettings):
     HOST: str = "0.0.0.0"
     PORT: int = 8000
 
-    # CORS
+    # CORS: явный список источников. "*" (любой источник) добавляется только при DEBUG -
+    # с явным списком браузер может кешировать preflight-ответы (CORS_MAX_AGE)
     CORS_ORIGINS: List[str] = [
         "http://localhost:8000",
         "http://127.0.0.1:8000",
         "http://localhost:3000",
         "http://localhost:5173",
-        "*"  # Разрешить все для локальной разработки
     ]
+    CORS_MAX_AGE: int = 86400  # Сколько секунд браузер кеширует ответ на OPTIONS
 
     # Регистрация
     ALLOW_REGISTRATION: bool = True
@@ -54,14 +55,21 @@ class Settings(BaseSettings):
     # Если указана - документы будут сохраняться туда вместо outputs/
     CUSTOM_OUTPUT_DIR: str = ""
 
+    # Отдача готовых файлов через nginx (X-Accel-Redirect).
+    # В nginx: location /_protected/ { internal; alias <папка документов>/; }
+    USE_XACCEL: bool = False
+    XACCEL_PREFIX: str = "/_protected/"
+
     class Config:
         env_file = ".env"
         case_sensitive = True
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        # Создаем директории при инициализации
+    def ensure_dirs(self) -> None:
+        """Создать рабочие директории. Вызывается при импорте app.main (StaticFiles
+        для /uploads проверяет папку сразу при монтировании) - в том числе в spawn-процессах
+        пула генерации, которые импортируют главный модуль (папки к тому моменту уже есть)"""
         self.UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+        (self.UPLOAD_DIR / "signatures").mkdir(exist_ok=True)
         self.OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 
@@ -1,17 +1,53 @@
 """
 Настройка базы данных
 """
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from .config import settings
+from collections import defaultdict
 import logging
 
 # Создаем engine
-engine = create_engine(
-    settings.DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in settings.DATABASE_URL else {}
-)
+if "sqlite" in settings.DATABASE_URL:
+    # Пул соединений оставляем: PRAGMA ниже, кеш страниц и mmap живут в соединении,
+    # и без пула (NullPool) они терялись бы на каждом запросе.
+    # timeout: при занятой записи ждать блокировку до 30 с, а не сразу падать с "database is locked"
+    engine = create_engine(
+        settings.DATABASE_URL,
+        connect_args={"check_same_thread": False, "timeout": 30}
+    )
+
+    # Настройки SQLite действуют на соединение - задаем их каждому новому:
+    # WAL (читатели не ждут писателя, без fsync на каждую транзакцию),
+    # кеш 16 МБ и mmap 256 МБ, временные таблицы в памяти, проверка внешних ключей
+    _SQLITE_PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA cache_size=-16000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA foreign_keys=ON",
+    )
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for pragma in _SQLITE_PRAGMAS:
+                cursor.execute(pragma)
+        finally:
+            cursor.close()
+else:
+    # Пул соединений для серверной БД (PostgreSQL): запас под пиковую нагрузку
+    # и проверка/пересоздание соединений, закрытых сервером
+    engine = create_engine(
+        settings.DATABASE_URL,
+        pool_size=20,
+        max_overflow=10,
+        pool_pre_ping=True,
+        pool_recycle=3600
+    )
 
 # Создаем SessionLocal класс
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -38,11 +74,24 @@ def ensure_sqlite_schema():
 
     try:
         with engine.begin() as conn:
+            # Колонки всех таблиц и список индексов - одним запросом,
+            # а не отдельным PRAGMA на каждую таблицу
+            columns = defaultdict(set)
+            indexes = set()
+            for kind, table, name in conn.execute(text(
+                "SELECT 'column', m.name, p.name FROM sqlite_master AS m "
+                "JOIN pragma_table_info(m.name) AS p "
+                "WHERE m.type = 'table' AND m.name IN ('trips', 'receipts', 'users') "
+                "UNION ALL "
+                "SELECT 'index', tbl_name, name FROM sqlite_master WHERE type = 'index'"
+            )):
+                if kind == 'index':
+                    indexes.add(name)
+                else:
+                    columns[table].add(name)
+
             # Миграции для таблицы trips
-            trips_cols = {
-                row[1]
-                for row in conn.execute(text("PRAGMA table_info(trips)")).fetchall()
-            }
+            trips_cols = columns['trips']
 
             migrations = []
             if "prikaz_date" not in trips_cols:
@@ -60,11 +109,14 @@ def ensure_sqlite_schema():
                     "ALTER TABLE trips ADD COLUMN post_trip_docs_generated BOOLEAN DEFAULT 0"
                 )
 
+            if "ix_trips_user_id_date_from_id" not in indexes:
+                migrations.append(
+                    "CREATE INDEX IF NOT EXISTS ix_trips_user_id_date_from_id "
+                    "ON trips (user_id, date_from, id)"
+                )
+
             # Миграции для таблицы receipts
-            receipts_cols = {
-                row[1]
-                for row in conn.execute(text("PRAGMA table_info(receipts)")).fetchall()
-            }
+            receipts_cols = columns['receipts']
 
             if "document_type" not in receipts_cols:
                 migrations.append(
@@ -74,20 +126,73 @@ def ensure_sqlite_schema():
                 migrations.append(
                     "ALTER TABLE receipts ADD COLUMN requires_amount BOOLEAN DEFAULT 1"
                 )
+            if "user_id" not in receipts_cols:
+                migrations.append(
+                    "ALTER TABLE receipts ADD COLUMN user_id INTEGER REFERENCES users(id)"
+                )
+                migrations.append(
+                    "UPDATE receipts SET user_id = "
+                    "(SELECT trips.user_id FROM trips WHERE trips.id = receipts.trip_id)"
+                )
+            if "file_size" not in receipts_cols:
+                migrations.append(
+                    "ALTER TABLE receipts ADD COLUMN file_size BIGINT"
+                )
+            if "sha256" not in receipts_cols:
+                migrations.append(
+                    "ALTER TABLE receipts ADD COLUMN sha256 VARCHAR(64)"
+                )
+            if "parse_attempted_at" not in receipts_cols:
+                migrations.append(
+                    "ALTER TABLE receipts ADD COLUMN parse_attempted_at DATETIME"
+                )
+            if "parse_warning" not in receipts_cols:
+                migrations.append(
+                    "ALTER TABLE receipts ADD COLUMN parse_warning VARCHAR"
+                )
+
+            # Индексы проверяем по имени, а не только вместе с колонкой: их могли
+            # не создать (или удалить) при уже существующей колонке.
+            # (trip_id, sha256) служит и индексом по trip_id - чеки командировки
+            if "ix_receipts_user_id" not in indexes:
+                migrations.append(
+                    "CREATE INDEX IF NOT EXISTS ix_receipts_user_id ON receipts (user_id)"
+                )
+            if "ix_receipts_trip_id_sha256" not in indexes:
+                migrations.append(
+                    "CREATE INDEX IF NOT EXISTS ix_receipts_trip_id_sha256 "
+                    "ON receipts (trip_id, sha256)"
+                )
 
             # Миграции для таблицы users
-            users_cols = {
-                row[1]
-                for row in conn.execute(text("PRAGMA table_info(users)")).fetchall()
-            }
+            users_cols = columns['users']
 
             if "signature_path" not in users_cols:
                 migrations.append(
                     "ALTER TABLE users ADD COLUMN signature_path VARCHAR"
                 )
 
+            # Все ALTER идут в одной транзакции: одна фиксация на диск на весь набор.
+            # executescript здесь не подходит - он сам делает COMMIT посреди транзакции
             for stmt in migrations:
                 conn.execute(text(stmt))
                 logger.info("[DB] Applied schema migration: %s", stmt)
+
+            # После изменения схемы статистика планировщика пуста или устарела -
+            # собираем ее сразу, чтобы первые запросы шли по индексам
+            if migrations:
+                conn.execute(text("ANALYZE"))
     except Exception as exc:
         logger.error("[DB] Failed to ensure SQLite schema: %s", exc, exc_info=True)
+
+
+def optimize_sqlite():
+    """PRAGMA optimize: SQLite сам обновит статистику по таблицам, где она нужна."""
+    if "sqlite" not in settings.DATABASE_URL:
+        return
+
+    try:
+        with engine.begin() as conn:
+            conn.execute(text("PRAGMA optimize"))
+    except Exception as exc:
+        logging.getLogger(__name__).warning("[DB] PRAGMA optimize failed: %s", exc)
@@ -4,80 +4,69 @@
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, ORJSONResponse
 from pathlib import Path
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import hashlib
 import logging
-import traceback
 from .config import settings
-from .database import engine, Base, SessionLocal, ensure_sqlite_schema
+from .database import engine, Base, ensure_sqlite_schema, optimize_sqlite
 from .api import auth, trips, receipts, users, logs
 from .models.user import User
-from .utils.auth import get_password_hash
 
-# Создаем таблицы
-Base.metadata.create_all(bind=engine)
-# Подхватываем новые колонки в SQLite без миграций
-ensure_sqlite_schema()
+# Создаем рабочие директории: StaticFiles для /uploads ниже проверяет папку сразу при создании
+settings.ensure_dirs()
+
+
+# bcrypt-хеш пароля "test", посчитанный заранее: при каждом запуске (и каждом
+# перезапуске --reload) не тратим ~100 мс CPU на get_password_hash("test")
+TEST_USER_PASSWORD_HASH = "$2b$12$nnVxzXHt0.1R.mbyXusN4OrDhluGIokTxcwQjMmNQ2Kg873CA/PF2"
 
 
 def create_test_user():
     """Создает тестового пользователя для быстрого входа"""
-    db = SessionLocal()
+    # Один INSERT ... ON CONFLICT DO NOTHING вместо SELECT-ов и ветвлений:
+    # если test уже есть (в том числе рядом со старым test_user), ничего не меняется
+    insert = sqlite_insert if engine.dialect.name == "sqlite" else postgresql_insert
+    stmt = insert(User.__table__).values(
+        username="test",
+        hashed_password=TEST_USER_PASSWORD_HASH,
+        fio="Тестовый Пользователь",
+        tab_no="001",
+        email=None  # Без email, чтобы избежать конфликта со старым test_user
+    ).on_conflict_do_nothing(index_elements=["username"])
+
     try:
-        # Проверяем старого тестового пользователя test_user
-        test_user_old = db.query(User).filter(User.username == "test_user").first()
-
-        # Проверяем нового test
-        test_user = db.query(User).filter(User.username == "test").first()
-
-        if test_user_old and not test_user:
-            # Если есть старый test_user, создаем новый test БЕЗ email (чтобы не было конфликта)
-            new_test_user = User(
-                username="test",
-                hashed_password=get_password_hash("test"),
-                fio="Тестовый Пользователь",
-                tab_no="001",
-                email=None  # Без email, чтобы избежать конфликта
-            )
-            db.add(new_test_user)
-            db.commit()
-            print("[OK] Создан тестовый пользователь: test/test")
-        elif test_user:
-            print("[OK] Тестовый пользователь test уже существует")
-        elif test_user_old:
-            print("[OK] Тестовый пользователь test_user уже существует (используйте test_user/test для входа)")
-        else:
-            # Создаем первого тестового пользователя
-            new_test = User(
-                username="test",
-                hashed_password=get_password_hash("test"),
-                fio="Тестовый Пользователь",
-                tab_no="001",
-                email=None
-            )
-            db.add(new_test)
-            db.commit()
-            print("[OK] Создан тестовый пользователь: test/test")
+        with engine.begin() as conn:
+            created = conn.execute(stmt).rowcount
     except Exception as e:
         print(f"Ошибка создания тестового пользователя: {e}")
-        db.rollback()
-    finally:
-        db.close()
+        return
+
+    if created:
+        print("[OK] Создан тестовый пользователь: test/test")
+    else:
+        print("[OK] Тестовый пользователь test уже существует")
 
 # Создаем приложение
 app = FastAPI(
     title=settings.APP_NAME,
     version=settings.APP_VERSION,
-    debug=settings.DEBUG
+    debug=settings.DEBUG,
+    # orjson кодирует JSON в C - заметно быстрее стандартного json на списках командировок и чеков
+    default_response_class=ORJSONResponse
 )
 
 # CORS
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=settings.CORS_ORIGINS,
+    # Разрешить все источники - только для локальной разработки
+    allow_origins=settings.CORS_ORIGINS + ["*"] if settings.DEBUG else settings.CORS_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=settings.CORS_MAX_AGE,
 )
 
 # Подключаем роутеры
@@ -90,10 +79,42 @@ app.include_router(logs.router, prefix="/logs", tags=["Logging"])
 # Статические файлы (для загрузок)
 app.mount("/uploads", StaticFiles(directory=str(settings.UPLOAD_DIR)), name="uploads")
 
+
+class VersionedStaticFiles(StaticFiles):
+    """
+    Статика фронтенда: запросы с ?v=<хеш> кешируются браузером на год.
+
+    index.html ссылается на css/js с хешем содержимого, поэтому после изменения
+    файла меняется и URL - браузер не увидит старую версию из кеша.
+    """
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200 and scope.get("query_string", b"").startswith(b"v="):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+
 # Статические файлы фронтенда
 frontend_dir = Path(__file__).parent.parent.parent / "frontend"
-app.mount("/css", StaticFiles(directory=str(frontend_dir / "css")), name="css")
-app.mount("/js", StaticFiles(directory=str(frontend_dir / "js")), name="js")
+FRONTEND_ASSETS = ("/css/style.css", "/js/app.js")
+
+
+def _versioned_index_html() -> str:
+    """index.html, в котором ссылки на css/js дополнены хешем их содержимого"""
+    html = (frontend_dir / "index.html").read_text(encoding="utf-8")
+    for url in FRONTEND_ASSETS:
+        digest = hashlib.sha256((frontend_dir / url.lstrip("/")).read_bytes()).hexdigest()[:12]
+        html = html.replace(f'"{url}"', f'"{url}?v={digest}"')
+    return html
+
+
+# Страница и пути к файлам фронтенда готовятся один раз, а не в каждом запросе
+# (страница - в startup: процессы генерации, импортирующие этот модуль, ее не считают)
+INDEX_HTML = ""
+FAVICON_PATH = frontend_dir / "favicon.ico"
+app.mount("/css", VersionedStaticFiles(directory=str(frontend_dir / "css")), name="css")
+app.mount("/js", VersionedStaticFiles(directory=str(frontend_dir / "js")), name="js")
 
 
 logger = logging.getLogger(__name__)
@@ -102,8 +123,8 @@ logger = logging.getLogger(__name__)
 @app.exception_handler(Exception)
 async def global_exception_handler(request: Request, exc: Exception):
     """Глобальный обработчик ошибок — возвращает JSON вместо raw traceback"""
-    tb = traceback.format_exc()
-    logger.error(f"Unhandled exception on {request.method} {request.url}: {exc}\n{tb}")
+    # Traceback форматирует сам logging (exc_info) и только если запись реально пишется
+    logger.error("Unhandled exception on %s %s: %s", request.method, request.url, exc, exc_info=exc)
     return JSONResponse(
         status_code=500,
         content={"detail": f"Internal server error: {str(exc)}"}
@@ -113,13 +134,33 @@ async def global_exception_handler(request: Request, exc: Exception):
 @app.on_event("startup")
 async def startup_event():
     """Выполняется при запуске приложения"""
-    create_test_user()
+    global INDEX_HTML
+
+    # Таблицы и схему создаем здесь, а не при импорте: spawn-процессы пула генерации
+    # заново импортируют главный модуль (python -m app.main), и им это не нужно
+    Base.metadata.create_all(bind=engine)
+    # Подхватываем новые колонки в SQLite без миграций
+    ensure_sqlite_schema()
+
+    INDEX_HTML = _versioned_index_html()
+
+    # Тестовый вход test/test нужен только при разработке; в продакшене (DEBUG=False)
+    # такая учетная запись - лишняя дыра, а не удобство
+    if settings.DEBUG:
+        create_test_user()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Выполняется при остановке приложения"""
+    optimize_sqlite()
 
 
 @app.get("/")
 async def root():
     """Главная страница - веб интерфейс"""
-    return FileResponse(str(frontend_dir / "index.html"))
+    # no-cache: страницу браузер перепроверяет, чтобы всегда получать свежие ?v= ссылки
+    return HTMLResponse(INDEX_HTML, headers={"Cache-Control": "no-cache"})
 
 
 @app.get("/health")
@@ -131,9 +172,8 @@ async def health():
 @app.get("/favicon.ico")
 async def favicon():
     """Favicon - возвращаем пустой ответ чтобы избежать 404"""
-    favicon_path = frontend_dir / "favicon.ico"
-    if favicon_path.exists():
-        return FileResponse(str(favicon_path))
+    if FAVICON_PATH.exists():
+        return FileResponse(FAVICON_PATH)
     # Если favicon не существует, возвращаем прозрачный 1x1 ico
     return JSONResponse(content={}, status_code=204)
 
@@ -1,7 +1,7 @@
 """
 Модель чека/документа
 """
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, ForeignKey, Boolean, Text, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..database import Base
@@ -27,10 +27,14 @@ class Receipt(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     trip_id = Column(Integer, ForeignKey("trips.id"), nullable=False)
+    # Владелец (= trips.user_id), чтобы проверять права без JOIN с trips
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=True, index=True)
 
     # Файл
     file_path = Column(String, nullable=False)
     file_name = Column(String, nullable=False)
+    file_size = Column(BigInteger, nullable=True)  # Размер в байтах
+    sha256 = Column(String(64), nullable=True)  # Хеш содержимого (для поиска дублей)
 
     # Тип документа (определяет, нужна ли сумма)
     document_type = Column(String, default=DocumentType.FISCAL_RECEIPT)
@@ -53,6 +57,9 @@ class Receipt(Base):
     has_qr = Column(Boolean, default=False)
     is_manual = Column(Boolean, default=False)  # Данные введены вручную
     requires_amount = Column(Boolean, default=True)  # Требуется ли сумма для этого документа
+    parse_attempted_at = Column(DateTime, nullable=True)  # Последняя попытка распознать файл (UTC)
+    # Итог проверки распознанной суммы: amount_out_of_range | amount_invalid | amount_missing
+    parse_warning = Column(String, nullable=True)
 
     # Временные метки
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -61,5 +68,10 @@ class Receipt(Base):
     # Отношения
     trip = relationship("Trip", back_populates="receipts")
 
+    __table_args__ = (
+        # Поиск дублей при загрузке; по префиксу trip_id - и все чеки командировки
+        Index("ix_receipts_trip_id_sha256", "trip_id", "sha256"),
+    )
+
     def __repr__(self):
         return f"<Receipt(id={self.id}, type='{self.document_type}', category='{self.category}', amount={self.amount})>"
@@ -1,7 +1,7 @@
 """
 Модель командировки
 """
-from sqlalchemy import Column, Integer, String, Float, Date, Time, DateTime, ForeignKey, Text, Boolean
+from sqlalchemy import Column, Integer, String, Float, Date, Time, DateTime, ForeignKey, Text, Boolean, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from ..database import Base
@@ -65,5 +65,16 @@ class Trip(Base):
     user = relationship("User", back_populates="trips")
     receipts = relationship("Receipt", back_populates="trip", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        # Список командировок пользователя: сортировка и keyset-пагинация по (date_from, id)
+        Index("ix_trips_user_id_date_from_id", "user_id", "date_from", "id"),
+    )
+
+    @property
+    def folder_name(self) -> str:
+        """Имя папки с документами командировки: YYYY-MM-DD_Город"""
+        # date.isoformat() дает тот же YYYY-MM-DD, что и strftime, но без разбора формата
+        return f"{self.date_from.isoformat()}_{self.destination_city}"
+
     def __repr__(self):
         return f"<Trip(id={self.id}, destination='{self.destination_city}', date={self.date_from}, status='{self.status}')>"
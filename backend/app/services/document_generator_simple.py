@@ -9,22 +9,48 @@
 from pathlib import Path
 from datetime import date, datetime, timedelta
 from typing import Dict, Iterable, Optional
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal, ROUND_CEILING
+from functools import lru_cache
+from types import MappingProxyType
+import copy
+import errno
+import io
+import os
 import re
 import zipfile
 import shutil
 
 from docx import Document
-from openpyxl import load_workbook
+from lxml import etree
 from num2words import num2words
 import logging
 
-# win32com для работы с Excel (не портит файлы в отличие от openpyxl/xlwings)
-try:
-    import win32com.client as win32
-    HAS_WIN32COM = True
-except ImportError:
-    HAS_WIN32COM = False
+# Авансовый отчет: openpyxl/xlwings при сохранении портят шаблон (рисунки, параметры печати),
+# поэтому правим XML листа напрямую, остальные части xlsx копируются как есть
+AO_SHEET_PART = 'xl/worksheets/sheet1.xml'
+AO_WORKBOOK_PART = 'xl/workbook.xml'
+AO_FIRST_EXPENSE_ROW = 63
+AO_TOTAL_ROW = 85
+_XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+# Названия категорий расходов в АО и порядок строк
+AO_CATEGORY_NAMES = MappingProxyType({
+    'taxi': 'Такси',
+    'fuel': 'Топливо',
+    'hotel': 'Гостиница',
+    'restaurant': 'Автобус',
+    'bus': 'Автобус',
+    'flight': 'Самолет',
+    'airplane': 'Самолет',
+    'train': 'Поезд',
+    'самолет': 'Самолет',
+    'поезд': 'Поезд',
+    'автобус': 'Автобус',
+    'other': 'Представительские'
+})
+AO_CATEGORY_ORDER = ('fuel', 'taxi', 'flight', 'airplane', 'train', 'bus', 'hotel', 'restaurant', 'other')
 
 
 class SimpleDocumentGenerator:
@@ -36,8 +62,7 @@ class SimpleDocumentGenerator:
 
     def _get_trip_folder(self, trip_data: Dict) -> Path:
         """Возвращает путь к папке командировки"""
-        folder_name = f"{trip_data['date_from'].strftime('%Y-%m-%d')}_{trip_data['destination_city']}"
-        return self.output_dir / folder_name
+        return self.output_dir / self._get_folder_name(trip_data)
 
     def _ensure_folder_structure(self, trip_folder: Path) -> None:
         """Создает структуру папок если нужно"""
@@ -80,8 +105,8 @@ class SimpleDocumentGenerator:
         return results
 
     def _get_folder_name(self, trip_data: Dict) -> str:
-        """Возвращает имя папки для командировки"""
-        return f"{trip_data['date_from'].strftime('%Y-%m-%d')}_{trip_data['destination_city']}"
+        """Возвращает имя папки для командировки (как Trip.folder_name)"""
+        return f"{trip_data['date_from'].isoformat()}_{trip_data['destination_city']}"
 
     def _generate_sz_advance(self, trip_data: Dict, output_folder: Path) -> str:
         """
@@ -93,7 +118,7 @@ class SimpleDocumentGenerator:
         output_path = output_folder / "documents" / "Служебная_записка_аванс.docx"
 
         logger = logging.getLogger(__name__)
-        doc = Document(template_path)
+        doc = _load_docx_template(template_path)
 
         org_name = trip_data.get('org_name', 'ООО «ВЭМ»')
         fio = trip_data['fio']
@@ -192,7 +217,7 @@ class SimpleDocumentGenerator:
         output_path = output_folder / "documents" / "Служебная_записка_доплата.docx"
 
         logger = logging.getLogger(__name__)
-        doc = Document(template_path)
+        doc = _load_docx_template(template_path)
 
         org_name = trip_data.get('org_name', 'ООО «ВЭМ»')
         fio = trip_data['fio']
@@ -247,16 +272,20 @@ class SimpleDocumentGenerator:
 
         self._ensure_folder_structure(trip_folder)
 
-        results = {}
-
-        # 1. Приказ
-        results['prikaz'] = self._generate_prikaz(trip_data, trip_folder)
-
-        # 2. Авансовый отчет
-        results['ao'] = self._generate_ao(trip_data, trip_folder)
-
-        # 3. Служебная записка (старый вариант с total_expenses)
-        results['sz'] = self._generate_sz(trip_data, trip_folder)
+        # 1-3. Приказ, Авансовый отчет, Служебная записка (старый вариант с total_expenses).
+        # Документы независимы (свои шаблоны и файлы), а lxml и zlib отпускают GIL -
+        # генерируем их параллельно
+        generators = {
+            'prikaz': self._generate_prikaz,
+            'ao': self._generate_ao,
+            'sz': self._generate_sz,
+        }
+        with ThreadPoolExecutor(max_workers=len(generators)) as executor:
+            futures = {
+                key: executor.submit(generate, trip_data, trip_folder)
+                for key, generate in generators.items()
+            }
+            results = {key: future.result() for key, future in futures.items()}
 
         # 4. Копируем чеки
         self._copy_receipts(trip_data, trip_folder)
@@ -274,7 +303,7 @@ class SimpleDocumentGenerator:
         template_path = self.templates_dir / "prikaz_template.docx"
         output_path = output_folder / "documents" / "Приказ.docx"
 
-        doc = Document(template_path)
+        doc = _load_docx_template(template_path)
 
         destination_org = trip_data['destination_org']
         purpose = trip_data['purpose']
@@ -284,8 +313,10 @@ class SimpleDocumentGenerator:
         date_from = trip_data['date_from']
         date_to = trip_data['date_to']
 
-        logger.info("[PRIKAZ] Raw date_from=%s (type=%s), date_to=%s (type=%s)",
-                    date_from, type(date_from).__name__, date_to, type(date_to).__name__)
+        # Пошаговая диагностика - на DEBUG; имена типов не вычисляем, если уровень выключен
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[PRIKAZ] Raw date_from=%s (type=%s), date_to=%s (type=%s)",
+                         date_from, type(date_from).__name__, date_to, type(date_to).__name__)
 
         if isinstance(date_from, str):
             date_from = datetime.strptime(date_from, '%Y-%m-%d').date()
@@ -297,8 +328,8 @@ class SimpleDocumentGenerator:
         elif isinstance(date_to, datetime):
             date_to = date_to.date()
 
-        logger.info("[PRIKAZ] Converted date_from=%s, date_to=%s, days=%s",
-                    date_from, date_to, days)
+        logger.debug("[PRIKAZ] Converted date_from=%s, date_to=%s, days=%s",
+                     date_from, date_to, days)
 
         # Дата приказа = prikaz_date или сегодня
         order_date = trip_data.get('prikaz_date') or date.today()
@@ -308,7 +339,7 @@ class SimpleDocumentGenerator:
             order_date = order_date.date()
 
         tables = doc.tables
-        logger.info("[PRIKAZ] Found %d tables in document", len(tables))
+        logger.debug("[PRIKAZ] Found %d tables in document", len(tables))
         if len(tables) >= 8:
             # НЕ меняем: организация, ФИО, табельный - берем из шаблона!
             # Дата составления
@@ -318,7 +349,7 @@ class SimpleDocumentGenerator:
             # Количество дней
             tables[4].cell(0, 1).text = days
             # Даты командировки
-            logger.info("[PRIKAZ] Filling dates in table[5]: %s - %s", date_from, date_to)
+            logger.debug("[PRIKAZ] Filling dates in table[5]: %s - %s", date_from, date_to)
             self._fill_split_date(tables[5], date_from, date_to)
             # Цель
             tables[6].cell(0, 1).text = purpose
@@ -332,93 +363,57 @@ class SimpleDocumentGenerator:
         return str(output_path)
 
     def _generate_ao(self, trip_data: Dict, output_folder: Path) -> str:
-        """Генерирует Авансовый отчет через win32com (не портит файлы)"""
+        """Генерирует Авансовый отчет правкой XML листа в копии шаблона (не портит файлы)"""
         template_path = self.templates_dir / "ao_template.xlsx"
         output_path = output_folder / "documents" / "Авансовый_отчет.xlsx"
 
         logger = logging.getLogger(__name__)
 
-        if not HAS_WIN32COM:
-            logger.error("[AO] win32com not available!")
-            raise RuntimeError("win32com не установлен. Установите: pip install pywin32")
-
-        logger.info("[AO] Generating with win32com...")
-
-        # Копируем шаблон
-        shutil.copy(template_path, output_path)
-
-        # Открываем через win32com
-        excel = win32.Dispatch("Excel.Application")
-        excel.Visible = False
-        excel.DisplayAlerts = False
-
-        try:
-            wb = excel.Workbooks.Open(str(output_path.resolve()))
-            ws = wb.Sheets(1)
-
-            # Дата оформления документа (ячейка Z13) = ao_date или сегодня
-            doc_date = trip_data.get('ao_date')
-            if doc_date:
-                if isinstance(doc_date, str):
-                    doc_date = datetime.strptime(doc_date, '%Y-%m-%d').date()
-                elif isinstance(doc_date, datetime):
-                    doc_date = doc_date.date()
-            else:
-                doc_date = date.today()
-
-            ws.Range('Z13').Value = doc_date.strftime('%d.%m.%y')
-
-            # Маппинг категорий
-            category_names = {
-                'taxi': 'Такси',
-                'fuel': 'Топливо',
-                'hotel': 'Гостиница',
-                'restaurant': 'Автобус',
-                'bus': 'Автобус',
-                'flight': 'Самолет',
-                'airplane': 'Самолет',
-                'train': 'Поезд',
-                'самолет': 'Самолет',
-                'поезд': 'Поезд',
-                'автобус': 'Автобус',
-                'other': 'Представительские'
-            }
-            category_order = ['fuel', 'taxi', 'flight', 'airplane', 'train', 'bus', 'hotel', 'restaurant', 'other']
-
-            # Очищаем диапазон расходов
-            for clear_row in range(63, 85):
-                ws.Range(f'P{clear_row}').Value = None
-                ws.Range(f'Y{clear_row}').Value = None
-
-            # Заполняем расходы
-            row = 63
-            raw_expenses = trip_data.get('expenses_by_category', {})
-            expenses = {}
-            for key, amount in raw_expenses.items():
-                normalized_key = self._normalize_category_key(key)
-                expenses[normalized_key] = (expenses.get(normalized_key, 0) or 0) + (amount or 0)
-
-            for category in self._ordered_categories(expenses.keys(), category_order):
-                amount = expenses.get(category)
-                if amount and amount > 0:
-                    normalized_category = self._normalize_category_key(category)
-                    display_category = category_names.get(normalized_category, category)
-                    ws.Range(f'P{row}').Value = display_category
-                    ws.Range(f'Y{row}').Value = float(self._to_money(amount))
-                    row += 1
-
-            # Суточные
-            per_diem = trip_data.get('per_diem_to_pay', 0)
-            if per_diem > 0:
-                ws.Range(f'P{row}').Value = 'Суточные'
-                ws.Range(f'Y{row}').Value = float(self._to_money(per_diem))
-
-            wb.Save()
-            wb.Close()
-            logger.info("[AO] File saved successfully: %s", output_path)
-            return str(output_path)
-        finally:
-            excel.Quit()
+        # Дата оформления документа (ячейка Z13) = ao_date или сегодня
+        doc_date = trip_data.get('ao_date')
+        if doc_date:
+            if isinstance(doc_date, str):
+                doc_date = datetime.strptime(doc_date, '%Y-%m-%d').date()
+            elif isinstance(doc_date, datetime):
+                doc_date = doc_date.date()
+        else:
+            doc_date = date.today()
+
+        cells = {'Z13': doc_date.strftime('%d.%m.%y')}
+
+        # Очищаем диапазон расходов
+        for clear_row in range(AO_FIRST_EXPENSE_ROW, AO_TOTAL_ROW):
+            cells[f'P{clear_row}'] = None
+            cells[f'Y{clear_row}'] = None
+
+        raw_expenses = trip_data.get('expenses_by_category', {})
+        expenses = defaultdict(float)
+        for key, amount in raw_expenses.items():
+            expenses[self._normalize_category_key(key)] += amount or 0
+
+        # Строки расходов (название, сумма); ключи уже нормализованы - повторно не прогоняем
+        rows = [
+            (AO_CATEGORY_NAMES.get(category, category), float(self._to_money(expenses[category])))
+            for category in self._ordered_categories(expenses.keys(), AO_CATEGORY_ORDER)
+            if expenses[category] > 0
+        ]
+
+        # Суточные
+        per_diem = trip_data.get('per_diem_to_pay', 0)
+        if per_diem > 0:
+            rows.append(('Суточные', float(self._to_money(per_diem))))
+
+        for row, (name, amount) in enumerate(rows, start=AO_FIRST_EXPENSE_ROW):
+            cells[f'P{row}'] = name
+            cells[f'Y{row}'] = amount
+        total = sum(amount for _, amount in rows)
+
+        # В Y85 формула SUM - обновляем ее сохраненное значение для просмотрщиков без пересчета
+        cells[f'Y{AO_TOTAL_ROW}'] = self._to_money(total)
+
+        output_path.write_bytes(_patch_ao_xlsx(_load_template_bytes(template_path), cells))
+        logger.info("[AO] File saved successfully: %s", output_path)
+        return str(output_path)
 
     def _generate_sz(self, trip_data: Dict, output_folder: Path) -> str:
         """Генерирует Служебную записку (старый метод для совместимости)
@@ -428,7 +423,7 @@ class SimpleDocumentGenerator:
         output_path = output_folder / "documents" / "Служебная_записка.docx"
 
         logger = logging.getLogger(__name__)
-        doc = Document(template_path)
+        doc = _load_docx_template(template_path)
 
         doc_date = self._calculate_doc_date(trip_data['date_from'])
 
@@ -478,32 +473,35 @@ class SimpleDocumentGenerator:
                 ordered.append(key)
         return ordered
 
+    # Синонимы категорий -> ключ категории
+    _CATEGORY_KEYS = {
+        'самолет': 'airplane',
+        'airplane': 'airplane',
+        'flight': 'airplane',
+        'поезд': 'train',
+        'train': 'train',
+        'такси': 'taxi',
+        'taxi': 'taxi',
+        'топливо': 'fuel',
+        'fuel': 'fuel',
+        'гостиница': 'hotel',
+        'hotel': 'hotel',
+        'автобус': 'bus',
+        'bus': 'bus',
+        'ресторан': 'bus',
+        'restaurant': 'bus',
+        'представительские': 'other',
+        'other': 'other',
+    }
+
     @staticmethod
+    @lru_cache(maxsize=256)
     def _normalize_category_key(category: str) -> str:
+        # Различных категорий немного, поэтому результат кешируется
         if category is None:
             return 'other'
         raw = str(category).strip()
-        lower = raw.lower()
-        mapping = {
-            'самолет': 'airplane',
-            'airplane': 'airplane',
-            'flight': 'airplane',
-            'поезд': 'train',
-            'train': 'train',
-            'такси': 'taxi',
-            'taxi': 'taxi',
-            'топливо': 'fuel',
-            'fuel': 'fuel',
-            'гостиница': 'hotel',
-            'hotel': 'hotel',
-            'автобус': 'bus',
-            'bus': 'bus',
-            'ресторан': 'bus',
-            'restaurant': 'bus',
-            'представительские': 'other',
-            'other': 'other',
-        }
-        return mapping.get(lower, raw)
+        return SimpleDocumentGenerator._CATEGORY_KEYS.get(raw.lower(), raw)
 
     @staticmethod
     def _to_money(value: float) -> float:
@@ -551,10 +549,11 @@ class SimpleDocumentGenerator:
         table.cell(0, 7).text = year[2:]
 
     def _copy_receipts(self, trip_data: Dict, output_folder: Path):
-        """Копирует чеки"""
+        """Копирует чеки (параллельно - на медленном диске/NFS копии не ждут друг друга)"""
         receipts_folder = output_folder / "receipts"
         receipts = trip_data.get('receipts', [])
 
+        tasks = []
         for receipt in receipts:
             if 'file_path' not in receipt:
                 continue
@@ -566,54 +565,206 @@ class SimpleDocumentGenerator:
                 from ..config import settings
                 source = settings.BASE_DIR / source
 
+            tasks.append((source, receipts_folder / f"{receipt.get('category', 'other')}_{source.name}"))
+
+        if not tasks:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(RECEIPT_COPY_WORKERS, len(tasks))) as executor:
+            # list() - дождаться всех копий и пробросить первую ошибку
+            list(executor.map(lambda task: self._copy_receipt(*task), tasks))
+
+    @staticmethod
+    def _copy_receipt(source: Path, dest: Path) -> None:
+        """Копирует один чек; файла нет на диске - пропускаем, как и раньше"""
+        try:
+            _copy_file(source, dest)
+        except FileNotFoundError:
             if source.exists():
-                dest = receipts_folder / f"{receipt.get('category', 'other')}_{source.name}"
-                shutil.copy(source, dest)
+                raise
 
     def _create_zip(self, trip_folder: Path) -> str:
         """Создает ZIP архив ТОЛЬКО с чеками (не документами)"""
         zip_path = trip_folder / "receipts.zip"
         receipts_folder = trip_folder / "receipts"
 
-        # Удаляем старый ZIP
-        if zip_path.exists():
-            zip_path.unlink()
-
-        # Архивируем ТОЛЬКО папку receipts
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            if receipts_folder.exists():
-                for file_path in receipts_folder.rglob('*'):
-                    if file_path.is_file():
-                        arcname = file_path.relative_to(receipts_folder)
-                        zipf.write(file_path, arcname)
+        # Архивируем ТОЛЬКО папку receipts (старый ZIP перезаписывается режимом 'w').
+        # Папка плоская (_copy_receipts кладет файлы в корень), поэтому хватает
+        # одного scandir: тип файла берется из DirEntry, без stat на каждый
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zipf:
+            try:
+                with os.scandir(receipts_folder) as entries:
+                    for entry in entries:
+                        if entry.is_file(follow_symlinks=False):
+                            zipf.write(entry.path, entry.name, compress_type=zip_compress_type(entry.name))
+            except FileNotFoundError:
+                pass
 
         return str(zip_path)
 
 
+# Одновременных копий чеков: больше не ускоряет даже NFS
+RECEIPT_COPY_WORKERS = 8
+
+# Ошибки copy_file_range, при которых копируем обычным способом:
+# старое ядро, разные ФС, файловая система без поддержки вызова
+_COPY_FILE_RANGE_FALLBACK_ERRNOS = frozenset({errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL})
+
+
+def _copy_file(source: Path, dest: Path) -> None:
+    """
+    Копирует содержимое файла внутри ядра через copy_file_range (на Btrfs/XFS - reflink,
+    данные не копируются вовсе). Где вызова нет, - shutil.copyfile (на Linux это sendfile).
+    """
+    if hasattr(os, 'copy_file_range'):
+        src_fd = os.open(source, os.O_RDONLY)
+        try:
+            dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                remaining = os.fstat(src_fd).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(src_fd, dst_fd, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                if e.errno not in _COPY_FILE_RANGE_FALLBACK_ERRNOS:
+                    raise
+            finally:
+                os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+    shutil.copyfile(source, dest)
+
+
+# Уже сжатые форматы: повторный deflate почти не уменьшает размер, а CPU тратит
+# (docx/xlsx внутри - тоже ZIP)
+_INCOMPRESSIBLE_SUFFIXES = frozenset({
+    '.jpg', '.jpeg', '.png', '.pdf', '.webp', '.heic', '.docx', '.xlsx', '.zip'
+})
+
+
+# Сжимаются только мелкие текстовые/XML файлы: уровень 1 в разы быстрее уровня 6 по умолчанию,
+# а архив больше лишь на несколько процентов
+ZIP_COMPRESSLEVEL = 1
+
+
+def zip_compress_type(name: str) -> int:
+    """Метод сжатия для файла в ZIP: ZIP_STORED для уже сжатых форматов, иначе ZIP_DEFLATED"""
+    if os.path.splitext(name)[1].lower() in _INCOMPRESSIBLE_SUFFIXES:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+@lru_cache(maxsize=8)
+def _parsed_docx_template(path: str, mtime_ns: int):
+    """Разобранный шаблон docx; mtime в ключе - отредактированный шаблон разбирается заново"""
+    return Document(path)
+
+
+def _load_docx_template(template_path: Path):
+    """
+    Шаблон docx для заполнения.
+
+    Процессы пула генерации живут долго, поэтому шаблон разбирается в процессе
+    один раз, а на каждый документ делается deepcopy - почти вдвое быстрее разбора.
+    """
+    return copy.deepcopy(_parsed_docx_template(str(template_path), template_path.stat().st_mtime_ns))
+
+
+@lru_cache(maxsize=4)
+def _template_bytes(path: str, mtime_ns: int) -> bytes:
+    return Path(path).read_bytes()
+
+
+def _load_template_bytes(template_path: Path) -> bytes:
+    """Содержимое шаблона, прочитанное один раз на процесс (mtime в ключе, как у docx)"""
+    return _template_bytes(str(template_path), template_path.stat().st_mtime_ns)
+
+
+def _set_xlsx_cell(cell, value) -> None:
+    """
+    Записывает значение в элемент <c>: строки - inlineStr (sharedStrings не трогаем),
+    числа - <v>, None очищает ячейку. У ячейки с формулой меняется только сохраненное значение.
+    """
+    formula = cell.find(f'{_XLSX_NS}f')
+    for child in list(cell):
+        if child is not formula:
+            cell.remove(child)
+    cell.attrib.pop('t', None)
+    if value is None:
+        return
+    if isinstance(value, str):
+        cell.set('t', 'inlineStr')
+        inline = etree.SubElement(cell, f'{_XLSX_NS}is')
+        etree.SubElement(inline, f'{_XLSX_NS}t').text = value
+    else:
+        etree.SubElement(cell, f'{_XLSX_NS}v').text = f'{value:.15g}'
+
+
+def _patch_ao_xlsx(template_bytes: bytes, cells: Dict[str, object]) -> bytes:
+    """
+    Копия xlsx-шаблона с подставленными значениями ячеек первого листа.
+
+    Разбирается только XML листа (и workbook.xml - чтобы Excel пересчитал формулы
+    при открытии), остальные части архива переносятся без изменений.
+    """
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as template:
+        sheet = etree.fromstring(template.read(AO_SHEET_PART))
+        by_ref = {cell.get('r'): cell for cell in sheet.iter(f'{_XLSX_NS}c')}
+        for ref, value in cells.items():
+            cell = by_ref.get(ref)
+            if cell is None:
+                raise ValueError(f"В шаблоне нет ячейки {ref}")
+            _set_xlsx_cell(cell, value)
+
+        workbook = etree.fromstring(template.read(AO_WORKBOOK_PART))
+        calc_pr = workbook.find(f'{_XLSX_NS}calcPr')
+        if calc_pr is not None:
+            calc_pr.set('fullCalcOnLoad', '1')
+
+        patched = {
+            AO_SHEET_PART: etree.tostring(sheet, xml_declaration=True, encoding='UTF-8', standalone=True),
+            AO_WORKBOOK_PART: etree.tostring(workbook, xml_declaration=True, encoding='UTF-8', standalone=True),
+        }
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as output:
+            for item in template.infolist():
+                data = patched.get(item.filename)
+                output.writestr(item, data if data is not None else template.read(item))
+    return buffer.getvalue()
+
+
+def run_generation(
+    templates_dir: Path,
+    output_dir: Path,
+    method: str,
+    trip_data: Dict,
+    **kwargs
+) -> Dict[str, str]:
+    """
+    Точка входа для генерации в отдельном процессе.
+
+    Функция уровня модуля, чтобы ее можно было передать в ProcessPoolExecutor:
+    генератор создается уже в дочернем процессе, а trip_data - обычный dict.
+    """
+    generator = SimpleDocumentGenerator(templates_dir, output_dir)
+    return getattr(generator, method)(trip_data, **kwargs)
+
+
+# Коэффициенты суточных по часу выезда/приезда: до 12 - полный день выезда, 12-18 - половина,
+# после 18 - 0.4; для приезда наоборот
+_DEPARTURE_COEF = (1.0,) * 12 + (0.5,) * 6 + (0.4,) * 6
+_ARRIVAL_COEF = (0.4,) * 12 + (0.5,) * 6 + (1.0,) * 6
+
+
 def calculate_per_diem_days(date_from, date_to, departure_time, arrival_time) -> float:
     """Расчет суточных с коэффициентами"""
 
-    # Коэффициент выезда
-    if departure_time:
-        if departure_time.hour < 12:
-            departure_coef = 1.0
-        elif 12 <= departure_time.hour < 18:
-            departure_coef = 0.5
-        else:
-            departure_coef = 0.4
-    else:
-        departure_coef = 1.0
-
-    # Коэффициент приезда
-    if arrival_time:
-        if arrival_time.hour >= 18:
-            arrival_coef = 1.0
-        elif 12 <= arrival_time.hour < 18:
-            arrival_coef = 0.5
-        else:
-            arrival_coef = 0.4
-    else:
-        arrival_coef = 1.0
+    # Коэффициенты выезда и приезда (без времени - полный день)
+    departure_coef = _DEPARTURE_COEF[departure_time.hour] if departure_time else 1.0
+    arrival_coef = _ARRIVAL_COEF[arrival_time.hour] if arrival_time else 1.0
 
     # Полные дни
     days_diff = (date_to - date_from).days
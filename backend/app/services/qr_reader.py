@@ -1,21 +1,43 @@
 """
 Сервис для чтения и парсинга QR кодов с чеков
 """
+import os
 import re
+import threading
 import cv2
+from functools import lru_cache
 from pyzbar import pyzbar
 from datetime import datetime
 from typing import Optional, Dict, Tuple
 from pathlib import Path
-import fitz  # PyMuPDF
 import numpy as np
 
 
+# Детекторы OpenCV нельзя делить между потоками, а создавать на каждый файл дорого:
+# у каждого потока пула разбора свой экземпляр
+_thread_local = threading.local()
+
+
+def _qr_detector() -> "cv2.QRCodeDetector":
+    detector = getattr(_thread_local, "qr_detector", None)
+    if detector is None:
+        detector = _thread_local.qr_detector = cv2.QRCodeDetector()
+    return detector
+
+
+def _clahe() -> "cv2.CLAHE":
+    clahe = getattr(_thread_local, "clahe", None)
+    if clahe is None:
+        clahe = _thread_local.clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+    return clahe
+
+
 class QRReader:
     """Класс для чтения QR кодов с российских фискальных чеков"""
 
     # Глобальный OCR reader (создается один раз для всех запросов)
     _ocr_reader = None
+    _ocr_reader_lock = threading.Lock()
 
     # Regex для парсинга QR строки формата: t=YYYYMMDDThhmm&s=SUM&fn=...&i=...&fp=...&n=...
     QR_PATTERN = re.compile(
@@ -118,6 +140,14 @@ class QRReader:
     def _init_ocr_reader() -> Optional[object]:
         if QRReader._ocr_reader is not None:
             return QRReader._ocr_reader
+        # Чеки разбираются в нескольких потоках - модель загружаем только один раз
+        with QRReader._ocr_reader_lock:
+            if QRReader._ocr_reader is not None:
+                return QRReader._ocr_reader
+            return QRReader._load_ocr_reader()
+
+    @staticmethod
+    def _load_ocr_reader() -> Optional[object]:
         print("[OCR] Initializing EasyOCR reader (first time only)...")
         print("[OCR] Downloading models, please wait (this may take a few minutes)...")
         try:
@@ -147,7 +177,7 @@ class QRReader:
             return None
 
         # Метод 1: OpenCV QRCodeDetector
-        qr_detector = cv2.QRCodeDetector()
+        qr_detector = _qr_detector()
         data, bbox, _ = qr_detector.detectAndDecode(img)
 
         if data:
@@ -174,6 +204,9 @@ class QRReader:
         Читает QR код из PDF файла
         Конвертирует страницы в изображения и ищет QR
         """
+        # PyMuPDF нужен только для PDF: импорт (~80 мс) откладываем до первого PDF-чека
+        import fitz
+
         try:
             doc = fitz.open(pdf_path)
             print(f"[QR] Открыт PDF: {pdf_path}, страниц: {len(doc)}")
@@ -227,7 +260,7 @@ class QRReader:
                 image_variants.append(("enhanced", enhanced))
 
                 # Попробуем все варианты
-                qr_detector = cv2.QRCodeDetector()
+                qr_detector = _qr_detector()
 
                 for variant_name, variant_img in image_variants:
                     # Метод 1: OpenCV QRCodeDetector
@@ -293,6 +326,8 @@ class QRReader:
         Парсит текст из PDF чека когда QR код не найден
         Ищет дату, сумму, ФН, ФД в тексте
         """
+        import fitz  # PyMuPDF, см. read_from_pdf
+
         try:
             doc = fitz.open(pdf_path)
             text = ""
@@ -514,10 +549,36 @@ class QRReader:
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
         # Увеличение контраста (CLAHE)
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-        enhanced = clahe.apply(gray)
+        enhanced = _clahe().apply(gray)
 
         # Бинаризация
         _, binary = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
 
         return binary
+
+
+@lru_cache(maxsize=1)
+def get_qr_reader() -> QRReader:
+    """Общий экземпляр QRReader (создается один раз на процесс)"""
+    return QRReader()
+
+
+@lru_cache(maxsize=4096)
+def _process_receipt_file_cached(
+    file_path: str, mtime_ns: int, size: int
+) -> Tuple[Optional[str], Optional[Dict]]:
+    """Результат process_receipt_file, закешированный по (путь, mtime, размер)"""
+    return get_qr_reader().process_receipt_file(file_path)
+
+
+def process_receipt_file_cached(file_path: str) -> Tuple[Optional[str], Optional[Dict]]:
+    """
+    То же, что QRReader.process_receipt_file, но без повторного разбора файла.
+
+    Ключ кеша включает mtime и размер, поэтому измененный файл разбирается заново.
+    Если файла нет, выбрасывает FileNotFoundError.
+    """
+    stat = os.stat(file_path)
+    qr_string, qr_data = _process_receipt_file_cached(file_path, stat.st_mtime_ns, stat.st_size)
+    # Отдаем копию: вызывающий код может править словарь (например, сбросить сумму)
+    return qr_string, dict(qr_data) if qr_data else qr_data
@@ -1,8 +1,13 @@
 """
 Утилиты для аутентификации и авторизации
 """
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
+import hashlib
+import hmac
+import threading
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
@@ -18,12 +23,50 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # OAuth2 схема
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/login")
 
+# Кэш недавно подтвержденных паролей: повторные входы с теми же данными
+# (например, серия обновлений страницы) не запускают bcrypt заново.
+# Хранятся только HMAC-ключи, сами пароли в памяти не остаются.
+VERIFY_CACHE_TTL_SECONDS = 60
+VERIFY_CACHE_MAXSIZE = 4096
+_verified_credentials: "OrderedDict[bytes, float]" = OrderedDict()
+_verified_credentials_lock = threading.Lock()
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Проверяет пароль"""
     return pwd_context.verify(plain_password, hashed_password)
 
 
+def _credentials_key(plain_password: str, hashed_password: str) -> bytes:
+    """Ключ кэша: HMAC от пароля и его хеша (смена пароля инвалидирует запись)"""
+    return hmac.new(
+        settings.SECRET_KEY.encode(),
+        f"{hashed_password}:{plain_password}".encode(),
+        hashlib.sha256
+    ).digest()
+
+
+def verify_password_cached(plain_password: str, hashed_password: str) -> bool:
+    """Проверяет пароль, запоминая успешную проверку на VERIFY_CACHE_TTL_SECONDS"""
+    key = _credentials_key(plain_password, hashed_password)
+    now = time.monotonic()
+
+    with _verified_credentials_lock:
+        expires_at = _verified_credentials.get(key)
+        if expires_at is not None and expires_at > now:
+            return True
+
+    if not verify_password(plain_password, hashed_password):
+        return False
+
+    with _verified_credentials_lock:
+        _verified_credentials[key] = now + VERIFY_CACHE_TTL_SECONDS
+        _verified_credentials.move_to_end(key)
+        while len(_verified_credentials) > VERIFY_CACHE_MAXSIZE:
+            _verified_credentials.popitem(last=False)
+    return True
+
+
 def get_password_hash(password: str) -> str:
     """Хеширует пароль"""
     return pwd_context.hash(password)
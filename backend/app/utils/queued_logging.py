@@ -0,0 +1,34 @@
+"""
+Логирование в файл через очередь: запись на диск идет в фоновом потоке
+"""
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+
+
+def attach_queued_file_handler(
+    logger: logging.Logger,
+    path: Path,
+    formatter: logging.Formatter
+) -> QueueListener:
+    """
+    Подключает к логгеру файловый handler через QueueHandler/QueueListener.
+
+    Поток запроса только кладет запись в очередь, а запись на диск выполняет
+    поток QueueListener. При выходе из процесса слушатель дописывает очередь.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    file_handler = logging.FileHandler(path, encoding="utf-8", delay=True)
+    file_handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -636,11 +636,14 @@ async function loadReceipts(tripId) {
 
         if (response.ok) {
             const trip = await response.json();
-            displayReceipts(trip.receipts || []);
+            const receipts = trip.receipts || [];
+            displayReceipts(receipts);
+            return receipts;
         }
     } catch (error) {
         console.error('Load receipts error:', error);
     }
+    return null;
 }
 
 // Отображение чеков
@@ -746,6 +749,8 @@ async function handleReceiptUpload(event) {
     // Загружаем все файлы по очереди
     let successCount = 0;
     let failCount = 0;
+    // Чеки, сумма которых распознаётся на сервере в фоне
+    const recognizingReceipts = [];
 
     // Показываем модальное окно прогресса
     showProgressModal(files.length);
@@ -774,14 +779,8 @@ async function handleReceiptUpload(event) {
                 successCount++;
                 const result = await response.json();
                 console.log(`[${i+1}/${files.length}] Загружен: ${file.name}`);
-                if (result && Array.isArray(result.warnings) && result.warnings.length > 0) {
-                    if (result.warnings.includes('amount_out_of_range')) {
-                        showNotification(`Проверьте сумму в ${file.name} (вне диапазона)`, 'error');
-                    } else if (result.warnings.includes('amount_invalid')) {
-                        showNotification(`Проверьте сумму в ${file.name} (некорректная)`, 'error');
-                    } else if (result.warnings.includes('amount_missing')) {
-                        showNotification(`Сумма не распознана: ${file.name}. Введите вручную.`, 'error');
-                    }
+                if (result && result.status === 'pending') {
+                    recognizingReceipts.push({ id: result.id, fileName: file.name });
                 }
 
                 // Обновляем список чеков сразу после каждой успешной загрузки
@@ -821,6 +820,55 @@ async function handleReceiptUpload(event) {
 
     loadReceipts(tripId);
     event.target.value = ''; // Очистить input
+
+    // QR/OCR распознаётся на сервере в фоне - обновляем список, пока суммы не появятся
+    if (recognizingReceipts.length > 0) {
+        refreshReceiptsWhileRecognizing(tripId, recognizingReceipts);
+    }
+}
+
+// Предупреждения распознавания суммы (parse_warning чека)
+const RECEIPT_WARNING_MESSAGES = {
+    amount_out_of_range: name => `Проверьте сумму в ${name} (вне диапазона)`,
+    amount_invalid: name => `Проверьте сумму в ${name} (некорректная)`,
+    amount_missing: name => `Сумма не распознана: ${name}. Введите вручную.`
+};
+
+// Показать предупреждения по распознанным чекам; возвращает те, что ещё распознаются
+function notifyRecognizedReceipts(receipts, recognizing) {
+    const byId = new Map(receipts.map(receipt => [receipt.id, receipt]));
+    return recognizing.filter(({ id, fileName }) => {
+        const receipt = byId.get(id);
+        if (!receipt) {
+            return false; // чек удалили
+        }
+        if (receipt.recognition_pending) {
+            return true;
+        }
+        const message = RECEIPT_WARNING_MESSAGES[receipt.parse_warning];
+        if (message) {
+            showNotification(message(fileName), 'error');
+        }
+        return false;
+    });
+}
+
+// Перечитывать чеки, пока сервер их распознаёт (recognition_pending).
+// Первый OCR загружает модели EasyOCR и может идти минуты - ждём до 10 минут
+function refreshReceiptsWhileRecognizing(tripId, recognizing, attempt = 1) {
+    const maxAttempts = 200;
+    setTimeout(async () => {
+        if (currentTripId !== tripId) {
+            return;
+        }
+        const receipts = await loadReceipts(tripId);
+        if (receipts) {
+            recognizing = notifyRecognizedReceipts(receipts, recognizing);
+        }
+        if (recognizing.length > 0 && attempt < maxAttempts) {
+            refreshReceiptsWhileRecognizing(tripId, recognizing, attempt + 1);
+        }
+    }, 3000);
 }
 
 // Редактирование чека